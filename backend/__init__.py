@@ -2,4 +2,5 @@ import db
 from crawl_queue import CrawlQueue
 from crawl_files import CrawlFileController
 from crawl_processor import CrawlProcessor
-from process_queue import ProcessQueue
\ No newline at end of file
+from process_queue import ProcessQueue
+from extractors import get_extractor, BoilerPipeExtractor, DensityExtractor
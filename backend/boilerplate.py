@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+#
+# Per-domain boilerplate sentence suppression
+#
+# Each domain has a redis hash of sentence fingerprint => number of pages
+# the sentence has appeared on. Sentences seen on more than THRESHOLD
+# pages of the same domain (navigation, footers, legal text) are dropped
+# before tokenization, classification and storage.
+#
+# So a domain's hash doesn't grow forever, every PRUNE_EVERY pages its
+# counts are halved, sentences which reach zero (seen once or twice since
+# the last prune) are dropped and at most max_fields of the rest are kept.
+# Sentences a domain keeps repeating stay well above the threshold.
+#
+
+import hashlib
+import logging
+
+from collections import Counter
+
+from redis.exceptions import WatchError
+
+BOILERPLATE_THRESHOLD = 5
+FINGERPRINT_TTL = 30 * 24 * 60 * 60 # seconds without a page from the domain
+PRUNE_EVERY = 1000 # pages from the domain
+MAX_FIELDS = 10000 # per domain, after pruning
+PRUNE_ATTEMPTS = 3 # before leaving it to the next prune
+
+# Counts the domain's pages since the last prune, alongside the fingerprints
+PAGES_FIELD = "pages"
+
+class DomainBoilerplateFilter(object):
+
+    def __init__(self, redis, threshold=BOILERPLATE_THRESHOLD, ttl=FINGERPRINT_TTL,
+        prune_every=PRUNE_EVERY, max_fields=MAX_FIELDS):
+        self.redis = redis
+        self.threshold = threshold
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.max_fields = max_fields
+        self.counters = Counter()
+
+    @classmethod
+    def fingerprint(cls, sentence):
+        normalized = u" ".join(sentence.lower().split())
+        if isinstance(normalized, unicode):
+            normalized = normalized.encode('utf-8')
+        return hashlib.md5(normalized).hexdigest()[:16]
+
+    def filter(self, domain_id, sentences, count=True):
+        # Counts this page against each of its sentences and returns the
+        # ones which aren't boilerplate, in one redis round trip. Pages
+        # being processed again pass count=False, so they aren't counted
+        # twice.
+        if len(sentences) == 0:
+            return sentences
+
+        key = "boilerplate:%d" % (domain_id,)
+        prints = [self.fingerprint(s) for s in sentences]
+        unique = list(set(prints))
+
+        if count:
+            pipe = self.redis.pipeline(transaction=False)
+            for fp in unique:
+                pipe.hincrby(key, fp, 1)
+            pipe.hincrby(key, PAGES_FIELD, 1)
+            pipe.expire(key, self.ttl)
+            results = pipe.execute()
+            counts = dict(zip(unique, results))
+            if results[len(unique)] % self.prune_every == 0:
+                self.prune(key)
+        else:
+            counts = dict(zip(unique, [int(c or 0) for c in self.redis.hmget(key, unique)]))
+
+        ret = [s for s, fp in zip(sentences, prints) if counts[fp] <= self.threshold]
+
+        suppressed = len(sentences) - len(ret)
+        self.counters["sentences"] += len(sentences)
+        self.counters["suppressed"] += suppressed
+        if suppressed > 0:
+            logging.debug("Suppressed %d of %d sentences as boilerplate for domain %d", suppressed, len(sentences), domain_id)
+        return ret
+
+    def prune(self, key):
+        # Halves every count, keeping the max_fields largest non-zero ones.
+        # The hash is WATCHed, so if another worker counts a page between
+        # reading and rewriting it, the prune starts again rather than
+        # losing that page's counts.
+        pipe = self.redis.pipeline(transaction=True)
+        try:
+            for attempt in range(PRUNE_ATTEMPTS):
+                try:
+                    pipe.watch(key)
+                    counts = pipe.hgetall(key)
+                    counts.pop(PAGES_FIELD, None)
+                    kept = sorted(((int(count) // 2, fp) for fp, count in counts.iteritems()), reverse=True)
+                    kept = dict((fp, count) for count, fp in kept[:self.max_fields] if count > 0)
+
+                    pipe.multi()
+                    pipe.delete(key)
+                    if len(kept) > 0:
+                        pipe.hmset(key, kept)
+                        pipe.expire(key, self.ttl)
+                    pipe.execute()
+                except WatchError:
+                    self.counters["prune_retries"] += 1
+                    continue
+                self.counters["pruned"] += len(counts) - len(kept)
+                logging.info("Pruned %s from %d to %d sentences", key, len(counts), len(kept))
+                return
+        finally:
+            pipe.reset()
+        logging.warning("Gave up pruning %s after %d attempts", key, PRUNE_ATTEMPTS)
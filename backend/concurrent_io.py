@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+#
+# Concurrent I/O engine
+#
+# Each item goes prepare -> compute -> finish. prepare and finish are
+# network-bound (MySQL, redis, BoilerPipe) and run on a pool of I/O
+# threads, which spend most of their time blocked on sockets, so many
+# articles' round trips are in flight at once. compute is CPU-bound and
+# runs on a pool of worker processes. At most max_in_flight items are
+# between prepare and finish at any time.
+#
+
+import logging
+import multiprocessing
+import Queue
+import threading
+import timeit
+
+from collections import Counter
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+IO_THREADS = 32
+MAX_IN_FLIGHT = 64
+REPORT_INTERVAL = 60 # seconds
+
+STEPS = ["prepare", "compute", "finish", "fail"]
+
+_STOP = "__stop__"
+
+def _call(func, *args):
+    # apply_async has no error callback on Python 2, so failures come
+    # back as results: (ok, value, seconds)
+    start = timeit.default_timer()
+    try:
+        ret = func(*args)
+    except Exception as ex:
+        logging.exception("%s failed: %s", func.__name__, ex)
+        return (False, None, timeit.default_timer() - start)
+    return (True, ret, timeit.default_timer() - start)
+
+class ConcurrentIOEngine(object):
+
+    def __init__(self, prepare, compute, finish, needs_compute=bool, fail=None,
+        io_threads=IO_THREADS, io_initializer=None, io_initargs=(),
+        cpu_workers=None, cpu_initializer=None,
+        max_in_flight=MAX_IN_FLIGHT, report_interval=REPORT_INTERVAL):
+        # compute and cpu_initializer are pickled to the worker processes,
+        # so must be module-level functions. Items whose prepared payload
+        # fails needs_compute go straight to finish. When a step raises,
+        # fail(step, that step's input) runs on an I/O thread instead, and
+        # its return value is yielded like finish's.
+        self.prepare = prepare
+        self.compute = compute
+        self.finish = finish
+        self.fail = fail
+        self.needs_compute = needs_compute
+        self.io_threads = io_threads
+        self.io_initializer = io_initializer
+        self.io_initargs = io_initargs
+        self.cpu_workers = cpu_workers
+        self.cpu_initializer = cpu_initializer
+        self.max_in_flight = max_in_flight
+        self.report_interval = report_interval
+
+        self.counters = Counter()
+        self.busy = Counter()
+        self._lock = threading.Lock()
+        self._started = None
+        self._finished = threading.Event()
+
+    def run(self, iterable):
+        # Yields finish's return values in completion order
+        self._started = timeit.default_timer()
+        # Fork the worker processes before any I/O thread exists, since a
+        # child can inherit a lock (logging's, say) held by one of them
+        self._cpu = multiprocessing.Pool(self.cpu_workers, self.cpu_initializer)
+        self._io = ThreadPool(self.io_threads, self.io_initializer, self.io_initargs)
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._results = Queue.Queue()
+
+        feeder = threading.Thread(target=self._feed, args=(iterable,), name="ConcurrentIOEngine-feeder")
+        feeder.daemon = True
+        feeder.start()
+
+        monitor = threading.Thread(target=self._monitor, name="ConcurrentIOEngine-monitor")
+        monitor.daemon = True
+        monitor.start()
+
+        while True:
+            item = self._results.get()
+            if item == _STOP:
+                break
+            yield item
+
+        self._finished.set()
+        for pool in [self._io, self._cpu]:
+            pool.close()
+            pool.join()
+        self.log_stats()
+
+    def _feed(self, iterable):
+        for item in iterable:
+            self._slots.acquire()
+            self._io.apply_async(_call, (self.prepare, item), callback=partial(self._prepared, item))
+
+        # Taking every slot waits for the last items to finish
+        for i in range(self.max_in_flight):
+            self._slots.acquire()
+        self._results.put(_STOP)
+
+    def _record(self, step, ret):
+        ok, value, elapsed = ret
+        with self._lock:
+            self.busy[step] += elapsed
+            if ok:
+                self.counters[step] += 1
+            else:
+                self.counters[step + "_failed"] += 1
+        return ok
+
+    def _failed(self, step, arg):
+        if self.fail is None:
+            self._slots.release()
+            return
+        self._io.apply_async(_call, (self.fail, step, arg), callback=partial(self._done, "fail", None))
+
+    def _prepared(self, item, ret):
+        if not self._record("prepare", ret):
+            return self._failed("prepare", item)
+        payload = ret[1]
+        if self.needs_compute(payload):
+            self._cpu.apply_async(_call, (self.compute, payload), callback=partial(self._computed, payload))
+        else:
+            self._io.apply_async(_call, (self.finish, payload), callback=partial(self._done, "finish", payload))
+
+    def _computed(self, payload, ret):
+        if not self._record("compute", ret):
+            return self._failed("compute", payload)
+        self._io.apply_async(_call, (self.finish, ret[1]), callback=partial(self._done, "finish", ret[1]))
+
+    def _done(self, step, payload, ret):
+        if not self._record(step, ret):
+            if step == "finish":
+                return self._failed(step, payload)
+        else:
+            self._results.put(ret[1])
+        self._slots.release()
+
+    def _monitor(self):
+        while not self._finished.wait(self.report_interval):
+            self.log_stats()
+
+    def stats(self):
+        # Returns (step, done, failed, busy seconds) for each step, and
+        # the number of items finished per second
+        elapsed = timeit.default_timer() - self._started
+        with self._lock:
+            ret = [(step, self.counters[step], self.counters[step + "_failed"], self.busy[step]) for step in STEPS]
+            rate = 0.0
+            if elapsed > 0:
+                rate = self.counters["finish"] / elapsed
+        return ret, rate
+
+    def log_stats(self):
+        steps, rate = self.stats()
+        for step, done, failed, busy in steps:
+            logging.info("Step %s: %d done, %d failed, %.1fs busy", step, done, failed, busy)
+        logging.info("ConcurrentIOEngine: %.2f items/sec, %d I/O threads, max %d in flight",
+            rate, self.io_threads, self.max_in_flight)
@@ -12,13 +12,15 @@ from boto.s3.bucket         import Bucket
 from boto.s3.key          	import Key
 
 from db import CrawlFile, CrawlController
+from xz_stream import decompress_chunks
 
 class CrawlFileController(object):
 
 	def __init__(self, controller):
 		self._controller = controller
 
-	def download_CrawlFile(self, which):
+	def get_CrawlFileKey(self, which):
+		# Returns the S3 Key for which, or None if it's missing
 		logging.info("Connecting to S3...")
 		conn   = boto.connect_s3()
 		bucket = which.src.key 
@@ -33,6 +35,12 @@ class CrawlFileController(object):
 			which.status = "Error"
 			self._controller.commit()
 			return None
+		return key
+
+	def download_CrawlFile(self, which):
+		key = self.get_CrawlFileKey(which)
+		if key is None:
+			return None
 
 		#tmp = tempfile.mktemp(suffix='bz2.sql', prefix='db-')
 		#fp  = open(tmp, 'wb')
@@ -57,6 +65,20 @@ class CrawlFileController(object):
 		fp.close()
 		return fname
 
+	def stream_CrawlFileSQL(self, which):
+		# Decompresses while downloading, into the file which gets opened,
+		# so there's one copy on disk and no separate xz pass afterwards
+		key = self.get_CrawlFileKey(which)
+		if key is None:
+			return None
+
+		handle, fname = tempfile.mkstemp()
+		os.close(handle)
+		logging.info("Downloading and decompressing %s to %s...", which.key, fname)
+		compressed, size = decompress_chunks(key, fname)
+		logging.info("Completed %s: %d bytes, %d decompressed", which.key, compressed, size)
+		return fname
+
 	def read_CrawlFileSQL(self, fname, delete_after=True):
 
 		logging.info("Opening database...")
@@ -74,15 +96,21 @@ class CrawlFileController(object):
 			os.remove(fname)
 
 
-	def read_CrawlFile(self, which):
+	def read_CrawlFile(self, which, stream=True):
+
+		if which.kind != "SQL":
+			raise Exception("Unimplemented")
+
+		if stream:
+			fname = self.stream_CrawlFileSQL(which)
+			if fname is None:
+				return None
+			return self.read_CrawlFileSQL(fname)
 
 		fp = self.download_CrawlFile(which)
 		if fp is None:
 			return None
 
-		if which.kind == "SQL":
-			fname = self.decompress_CrawlFileSQL(fp)
-			return self.read_CrawlFileSQL(fname)
-		else:
-			raise Exception("Unimplemented")
+		fname = self.decompress_CrawlFileSQL(fp)
+		return self.read_CrawlFileSQL(fname)
 
@@ -3,9 +3,8 @@
 # Crawl Processor 
 import itertools
 import logging
-import os
 import sys
-import threading
+import timeit
 import types
 
 from collections import Counter
@@ -15,29 +14,100 @@ from sqlalchemy import create_engine
 from sqlalchemy.exc import *
 from sqlalchemy.orm.session import Session 
 from topia.termextract import extract
-from nltk.tokenize import sent_tokenize
-import nltk
-from lxml import etree
-from bs4 import BeautifulSoup
 from pysen.documents import DocumentClassifier
 
-import langid
 import pydate
 import pysen
 import pysen.models
-import MySQLdb as mdb
 import redis
 
 from db import Article, Domain, DomainController, ArticleController
-from db import Keyword, KeywordController
-from db import SoftwareVersionsController
+from db import Keyword
 from db import Document, Sentence, Phrase
 from db import KeywordIncidence, SoftwareInvolvementRecord
 from db import CertainDate, AmbiguousDate, KeywordAdjacency
-from db import RelativeLink, AbsoluteLink
+from db import RelativeLink, AbsoluteLink, ArticleDuplicate
+from text_index import TextNodeIndex
+from document_model import parse_document, truncate, over_node_budget, MAX_PAGE_BYTES, MAX_DOM_NODES
+from prefilter import PreFilter
+from nlp import split_sentences, tag_sentences, tag_documents, topia_terms, topia_tagger
+import nlp
+import prefilter
+from boilerplate import DomainBoilerplateFilter
+from dedup import SimHashIndex, simhash
+from domain_ids import DomainIdService
+from keyword_ids import KeywordResolutionWorker
+from software_versions import SoftwareVersionRegistry
+from matcher import MultiPatternMatcher
+from extractors import BoilerPipeExtractor, ExtractionResult
+from stage_cache import digest
+from timings import timed
 
 KEYWORD_LIMIT = 32
 
+# Log the keyword resolution round trips every this many articles
+REPORT_EVERY = 500
+
+# Passed as _process_record's rejection when the pre-filter hasn't run yet
+UNCHECKED = object()
+
+def load_stop_list(path="keyword_filter.txt"):
+    with open(path) as fp:
+        return frozenset(line.strip() for line in fp)
+
+def preload_models(stop_list="keyword_filter.txt"):
+    # Loads the read-only models (classifier, stop list, NLTK and langid)
+    # into this process. Called before forking workers, they're shared
+    # copy-on-write rather than loaded again by every worker. Returns
+    # CrawlProcessor keyword arguments.
+    nlp.preload()
+    prefilter.preload()
+    return {"stop_list": load_stop_list(stop_list), "classifier": DocumentClassifier()}
+
+class ArticleState(object):
+
+    # What one article carries from stage to stage. Only plain data, so
+    # it can be pickled between stage worker processes.
+
+    def __init__(self, item):
+        crawl_id, record = item
+        headers, content, url, date_crawled, content_type = record
+
+        self.crawl_id     = crawl_id
+        self.url          = url
+        self.date_crawled = date_crawled
+        self.status       = "Processed"
+        self.finished     = False    # rejected, status says why
+        self.denied       = False    # rejected without an Article row
+        self.domain_id    = None
+
+        # extract_stage
+        self.headings     = None
+        self.anchors      = None
+        self.text_nodes   = None
+        self.date_dict    = None
+        self.body         = None     # extractor output
+        self.content      = None     # body without boilerplate sentences
+        self.sentences    = None
+        self.extractor_version = None
+        self.fingerprint  = None
+        self.duplicate_of = None
+        self.started      = None
+        self.timings      = {}       # stage => seconds
+
+        # analyse_stage
+        self.headline     = None
+        self.keywords     = None
+        self.keyword_words = None
+        self.nnp_adj      = None
+        self.features     = None
+        self.trace        = None
+
+    def reject(self, status):
+        self.status = status
+        self.finished = True
+        return self
+
 class KeywordSet(object):
 
     def __init__(self, stop_list):
@@ -68,49 +138,35 @@ class KeywordSet(object):
 
         return False 
 
-    def convert_adj_tuples(self, tuple_list, keyword_map, kwc):
-
+    def convert_adj_ids(self, tuple_list, keyword_map):
+        # Returns (key1 id, key2 id) for each pair which was resolved
         ret = []
 
         for i, j in tuple_list:
             try:
-                i, j = i.strip(), j.strip()
-                i = kwc.get_Keyword_fromId(keyword_map[i])
-                j = kwc.get_Keyword_fromId(keyword_map[j])
-                if i is not None and j is not None:
-                    ret.append((i,j))
-                else:
-                    logging.error("Couldn't resolve keyword pair.")
-            except ValueError as ex:
-                logging.error(ex)
+                ret.append((keyword_map[i.strip()], keyword_map[j.strip()]))
             except KeyError as ex:
                 logging.info(ex)
         return ret
 
-
-    def convert(self, keyword_map, kwc):
-        ret = []
-        short = []
+    def convert_ids(self, keyword_map):
+        # Returns {term: keyword id} for each term which was resolved
+        ret = {}
         for t in self.keywords:
             try:
-                ident = keyword_map[t]
-                k = kwc.get_Keyword_fromId(ident)
-                if k is not None:
-                    ret.append(k)
-                    continue
-                logging.error("Can't resolve keyword %s with iden %d", t, ident)
-            except ValueError as ex:
-                logging.error(ex)
+                ret[t] = keyword_map[t]
             except KeyError as ex:
                 logging.info(ex)
 
-        return ret, short
+        return ret
 
 class CrawlProcessor(object):
 
     __VERSION__ = "CrawlProcessor-0.2.1"
 
-    def __init__(self, engine, redis_server, stop_list="keyword_filter.txt"):
+    def __init__(self, engine, redis_server, stop_list="keyword_filter.txt", extractor=None, parse_mode="soup",
+        timing_log=None, classifier=None, max_page_bytes=MAX_PAGE_BYTES, max_dom_nodes=MAX_DOM_NODES,
+        stage_cache=None):
 
         if type(engine) == types.StringType:
             logging.info("Using connection string '%s'" % (engine,))
@@ -125,37 +181,67 @@ class CrawlProcessor(object):
         logging.info("Binding session...")
         self._session = Session(bind=self._engine, autocommit = False)
 
-        if type(stop_list) == types.StringType:
-            stop_list_fp = open(stop_list)
+        if isinstance(stop_list, frozenset):
+            # From preload_models, shared rather than copied
+            self.stop_list = stop_list
         else:
-            stop_list_fp = stop_list 
+            if type(stop_list) == types.StringType:
+                stop_list_fp = open(stop_list)
+            else:
+                stop_list_fp = stop_list 
 
-        self.stop_list = set([])
-        for line in stop_list_fp:
-            self.stop_list.add(line.strip())
+            self.stop_list = set([])
+            for line in stop_list_fp:
+                self.stop_list.add(line.strip())
 
-        self.cls = DocumentClassifier()
+        self._cls = classifier
         self.dc  = DomainController(self._engine, self._session)
         self.ac  = ArticleController(self._engine, self._session)
-        self.ex  = extract.TermExtractor()
-        self.kwc = KeywordController(self._engine, self._session)
-        self.swc = SoftwareVersionsController(self._engine, self._session)
+        self.ex  = extract.TermExtractor(tagger=topia_tagger)
+        self.versions = SoftwareVersionRegistry(Session(bind=self._engine, autocommit = False))
         self.redis_kw = redis.Redis(host=redis_server, port=6379, db=1)
         self.redis_dm = redis.Redis(host=redis_server, port=6379, db=2)
         dm_session = Session(bind=self._engine, autocommit = False)
-        self.drw = DomainResolutionWorker(dm_session, self.redis_dm)
-
+        self.domains = DomainIdService(dm_session, self.redis_dm)
+        self.redis_bp = redis.Redis(host=redis_server, port=6379, db=3)
+        self.bpf = DomainBoilerplateFilter(self.redis_bp)
+        self.redis_sh = redis.Redis(host=redis_server, port=6379, db=4)
+        self.dedup = SimHashIndex(self.redis_sh)
+
+        if extractor is None:
+            extractor = BoilerPipeExtractor()
+        self.extractor = extractor
+        self.parse_mode = parse_mode
+        self.prefilter = PreFilter()
+        self.max_page_bytes = max_page_bytes
+        self.max_dom_nodes = max_dom_nodes
+
+        # Remote extractors only report their version with a result, so
+        # cached extractions are used once one has come back
+        self.cache = stage_cache
+        self._extractor_version = getattr(extractor, "__VERSION__", None)
+        self._dates_version = "%s/%s" % (pydate.__VERSION__, parse_mode)
+
+        # (Article, ArticleState) awaiting commit, for the TimingLog
+        self.timing_log = timing_log
+        self._timed = []
+        self.keyword_counters = Counter()
+
+
+    @property
+    def cls(self):
+        # Loaded on first use, processors which only do I/O never need it
+        if self._cls is None:
+            self._cls = DocumentClassifier()
+        return self._cls
 
     def _check_processed(self, item):
         crawl_id, record = item 
         headers, content, url, date_crawled, content_type = record
 
         path   = self.ac.get_path_fromurl(url)
-        domain_identifier = None 
         logging.info("_check_processed: retrieving domain...")
-        domain_key = self.dc.get_Domain_key(url)
-        while domain_identifier == None:
-            domain_identifier = self.drw.get_domain(domain_key)
+        domain_identifier = self.domains.get(self.dc.get_Domain_key(url))
 
         it = self._session.query(Article).filter_by(crawl_id = crawl_id).filter_by(domain_id = domain_identifier).filter_by(path = path)
         try:
@@ -186,10 +272,196 @@ class CrawlProcessor(object):
                 raise ex 
         if ret == False:
             return None 
+
+        # Commit to database, return the Article's id on success
+        if not self._commit():
+            return None
         return ret 
 
+    def process_state(self, state):
+        # Persists and commits an ArticleState from extract_stage and
+        # analyse_stage, which may have run in other processes
+        ret = self.persist_stage(state)
+        if ret == False:
+            return None
+        if not self._commit():
+            return None
+        return ret
 
-    def _process_record(self, item_arg):
+    def process_batch(self, items):
+        # Extracts every item, analyses them together so their sentences
+        # are tagged in one call, persists each inside its own SAVEPOINT,
+        # then flushes and commits the whole batch once. Returns a list of
+        # Article ids (or None) in the same order as items.
+        pending = []
+        for item in items:
+            if len(item) != 2:
+                raise ValueError(item)
+            pending.append(self._check_processed(item))
+
+        # Run the cheap rejections, then send every surviving page in the
+        # batch to the extractor up front, unless it needs our parse tree
+        rejections = {}
+        for pos, item in enumerate(items):
+            if pending[pos]:
+                rejections[pos] = self._prefilter(item)
+        wanted = []
+        if not self.extractor.needs_tree:
+            wanted = [pos for pos in rejections if rejections[pos] is None
+                and not over_node_budget(self.page_content(items[pos][1][1]), self.max_dom_nodes)]
+        extractions = {}
+        for pos in wanted:
+            cached = self._cached_extraction(self.page_content(items[pos][1][1]))
+            if cached is not None:
+                extractions[pos] = cached
+        wanted = [pos for pos in wanted if pos not in extractions]
+        jobs = self.extractor.submit_many([self.page_content(items[pos][1][1]) for pos in wanted])
+        extractions.update(zip(wanted, jobs))
+
+        states = {}
+        for pos, item in enumerate(items):
+            if not pending[pos]:
+                continue
+            try:
+                states[pos] = self.extract_stage(item, extractions.get(pos), rejections[pos])
+            except Exception as ex:
+                self._discard(item, ex)
+
+        try:
+            self.analyse_batch(states.values())
+        except Exception as ex:
+            logging.error("Batch analysis failed (%s), analysing %d items individually", ex, len(states))
+            for pos in sorted(states):
+                try:
+                    self.analyse_stage(states[pos])
+                except Exception as ex:
+                    self._discard(items[pos], ex)
+                    del states[pos]
+
+        ret = []
+        for pos, item in enumerate(items):
+            if pos not in states:
+                ret.append(None)
+                continue
+            savepoint = self._session.begin_nested()
+            try:
+                result = self.persist_stage(states[pos])
+                savepoint.commit()
+            except Exception as ex:
+                self._discard(item, ex)
+                savepoint.rollback()
+                result = None
+            if result == False:
+                result = None
+            ret.append(result)
+
+        if self._commit():
+            return ret
+
+        # The batch commit failed, fall back to one transaction per record
+        logging.error("Batch commit failed, retrying %d items individually", len(items))
+        ret = []
+        for item in items:
+            try:
+                ret.append(self.process_record(item))
+            except Exception as ex:
+                logging.error(ex)
+                self._session.rollback()
+                ret.append(None)
+        return ret
+
+    def _discard(self, item, ex):
+        import traceback
+        print >> sys.stderr, ex
+        traceback.print_exc()
+        logging.error("Discarding batch item for %s", item[1][2])
+
+    def _commit(self):
+        start = timeit.default_timer()
+        pending, self._timed = self._timed, []
+        try:
+            self._session.flush()
+            # Rolled back Articles keep their flushed id, but leave the session
+            pending = [(article.id, state) for article, state in pending
+                if article in self._session and article.id is not None]
+            self._session.commit()
+        except OperationalError as ex:
+            logging.error(ex)
+            self._session.rollback()
+            return False
+        if self.timing_log is not None and len(pending) > 0:
+            # A batch shares one commit, so each article gets its share
+            elapsed = (timeit.default_timer() - start) / len(pending)
+            records = []
+            for article_id, state in pending:
+                state.timings["commit"] = elapsed
+                records.append((article_id, state.status, state.timings))
+            self.timing_log.write(records)
+        return True
+
+
+    def page_content(self, content):
+        # What the parser and extractor see of a page
+        return truncate(content, self.max_page_bytes)[0]
+
+    def _cached_extraction(self, content):
+        if self.cache is None:
+            return None
+        cached = self.cache.get("extract", digest(content), self._extractor_version)
+        if cached is None:
+            return None
+        return ExtractionResult(cached, self._extractor_version, from_cache=True)
+
+    def _finish_extraction(self, job, content):
+        # Once job's joined: remote extractors only report their version
+        # with a result, so learn it here and cache the result under it
+        if self.cache is None or job.result is None or getattr(job, "from_cache", False):
+            return
+        self._extractor_version = job.version
+        self.cache.put("extract", digest(content), job.version, job.result)
+
+    def _cached(self, stage, content, version, func, *args):
+        # func(*args), unless it's already been run on this content
+        if self.cache is None:
+            return func(*args)
+        key = digest(content)
+        ret = self.cache.get(stage, key, version)
+        if ret is None:
+            ret = func(*args)
+            self.cache.put(stage, key, version, ret)
+        return ret
+
+    def submit_extraction(self, content, tree=None):
+        # Starts extracting content, or returns a finished job if this
+        # content's already been extracted by the current version
+        ret = self._cached_extraction(content)
+        if ret is None:
+            ret = self.extractor.submit(content, tree)
+        return ret
+
+    def _prefilter(self, item):
+        crawl_id, record = item
+        headers, content, url, date_crawled, content_type = record
+        return self.prefilter.check(url, content, content_type)
+
+    def _resolve_domain(self, url):
+        logging.info("Retrieving domain...")
+        return self.domains.get(self.dc.get_Domain_key(url))
+
+    def _process_record(self, item_arg, extraction=None, rejection=UNCHECKED):
+        state = self.extract_stage(item_arg, extraction, rejection)
+        state = self.analyse_stage(state)
+        return self.persist_stage(state)
+
+    def extract_stage(self, item_arg, extraction=None, rejection=UNCHECKED):
+        # Pre-filter, parse, extract the main content and dates
+        state = self.prepare_stage(item_arg, rejection)
+        if state.finished:
+            return state
+        return self.parse_stage(state, item_arg[1][1], extraction)
+
+    def prepare_stage(self, item_arg, rejection=UNCHECKED):
+        # Pre-filter and resolve the domain
 
         crawl_id, record = item_arg
         headers, content, url, date_crawled, content_type = record
@@ -200,89 +472,159 @@ class CrawlProcessor(object):
         assert date_crawled is not None 
         assert content_type is not None 
 
-        status = "Processed"
+        state = ArticleState(item_arg)
 
-        # Fix for a seg-fault
-        if "nasa.gov" in url:
-            return False
+        # Cheap rejections first: deny list, content type and language
+        if rejection is UNCHECKED:
+            with timed(state.timings, "prefilter"):
+                rejection = self._prefilter(item_arg)
+        if rejection == PreFilter.DENIED:
+            state.denied = True
+            return state.reject(rejection)
 
         # Sort out the domain
-        domain_identifier = None 
-        logging.info("Retrieving domain...")
-        domain_key = self.dc.get_Domain_key(url)
-        while domain_identifier == None:
-            domain_identifier = self.drw.get_domain(domain_key)
+        with timed(state.timings, "domain"):
+            state.domain_id = self._resolve_domain(url)
 
-        domain = self._session.query(Domain).get(domain_identifier)
-        assert domain is not None
+        if rejection is not None:
+            return state.reject(rejection)
+        return state
 
-        # Build database objects 
-        path   = self.ac.get_path_fromurl(url)
-        article = Article(path, date_crawled, crawl_id, domain, status)
-        self._session.add(article)
-        classified_by = self.swc.get_SoftwareVersion_fromstr(pysen.__VERSION__)
-        assert classified_by is not None
+    def parse_stage(self, state, content, extraction=None):
+        # Parse, extract the main content and dates
 
-        if content_type != 'text/html':
-            logging.error("Unsupported content type: %s", str(content_type))
-            article.status = "UnsupportedType"
-            return False
+        # Oversize pages are cut short, and recorded as such
+        content, truncated = truncate(content, self.max_page_bytes)
+        if truncated:
+            logging.info("%s: truncated to %d bytes", state.url, len(content))
+            state.status = "Truncated"
+
+        # Oversize trees are rejected before anything's spent on them
+        with timed(state.timings, "parse"):
+            too_large = over_node_budget(content, self.max_dom_nodes)
+        if too_large:
+            logging.info("%s: more than %d DOM nodes - skipping...", state.url, self.max_dom_nodes)
+            return state.reject("TooLarge")
 
         # Start the async transaction to get the plain text
-        worker_req_thread = BoilerPipeWorker(content)
-        worker_req_thread.start()
+        worker_req_thread = extraction
+        if worker_req_thread is None and not self.extractor.needs_tree:
+            worker_req_thread = self.submit_extraction(content)
 
         # Whilst that's executing, parse the document 
         logging.info("Parsing HTML...")
-        html = BeautifulSoup(content)
+        with timed(state.timings, "parse"):
+            html = parse_document(content, self.parse_mode, self.max_dom_nodes, precheck=False)
 
-        if html is None or html.body is None:
-            article.status = "NoContent"
-            return False
+        if html.too_large:
+            logging.info("%s: more than %d DOM nodes - skipping...", state.url, self.max_dom_nodes)
+            return state.reject("TooLarge")
 
-        # Extract the dates 
-        date_dict = pydate.get_dates(html)
+        if not html.has_body:
+            return state.reject("NoContent")
 
-        if len(date_dict) == 0:
-            status = "NoDates"
+        if worker_req_thread is None:
+            with timed(state.timings, "extract"):
+                worker_req_thread = self.submit_extraction(content, html.tree)
 
-        # Detect the language
-        lang, lang_certainty = langid.classify(content)
+        state.headings   = html.headings
+        state.anchors    = [(link, [unicode(node) for node in nodes]) for link, nodes in html.anchors]
+        state.text_nodes = [(unicode(node), tag) for node, tag in html.text_nodes]
 
-        # Wait for the BoilerPipe thread to complete
-        worker_req_thread.join()
+        # Extract the dates 
+        with timed(state.timings, "dates"):
+            state.date_dict = self._cached("dates", content, self._dates_version, lambda: pydate.get_dates(html.soup))
+
+        if len(state.date_dict) == 0 and state.status == "Processed":
+            state.status = "NoDates"
+
+        # Wait for the extractor to complete
+        with timed(state.timings, "extract"):
+            worker_req_thread.join()
         logging.debug(worker_req_thread.result)
         logging.debug(worker_req_thread.version)
 
         if worker_req_thread.result == None:
-            article.status = "NoContent"
-            return False
-
-        # If the language isn't English, skip it
-        if lang != "en":
-            logging.info("language: %s with certainty %.2f - skipping...", lang, lang_certainty)
-            article.status = "LanguageError" # Replace with something appropriate
-            return False
+            return state.reject("NoContent")
 
+        state.body = worker_req_thread.result
+        state.extractor_version = worker_req_thread.version
+        self._finish_extraction(worker_req_thread, content)
         content = worker_req_thread.result.encode('ascii', 'ignore')
 
+        # Near-duplicates (syndicated stories etc.) share an existing analysis
+        state.started = timeit.default_timer()
+        with timed(state.timings, "dedup"):
+            state.fingerprint = simhash(content)
+            state.duplicate_of = self.dedup.find(state.fingerprint)
+        state.content = content
+        if state.duplicate_of is not None:
+            return state
+
+        return self._filter_boilerplate(state)
+
+    def _filter_boilerplate(self, state):
+        # Drop sentences this domain repeats on many pages
+        with timed(state.timings, "boilerplate"):
+            sentences = self.bpf.filter(state.domain_id, split_sentences(state.content))
+        if len(sentences) == 0:
+            logging.info("Only boilerplate left - skipping...")
+            return state.reject("NoContent")
+        state.sentences = sentences
+        state.content = " ".join(sentences)
+        return state
+
+    def analyse_stage(self, state):
+        # Headline, keywords, NNP adjacencies and sentiment classification
+
+        if state.finished or state.duplicate_of is not None:
+            return state
+
+        with timed(state.timings, "pos_tag"):
+            tagged_sentences = tag_sentences(state.sentences)
+        return self._analyse_tagged(state, tagged_sentences)
+
+    def analyse_batch(self, states):
+        # analyse_stage for many articles, tagging all their sentences in
+        # one call. Each article is charged its share of the tagging time.
+        live = [state for state in states if not state.finished and state.duplicate_of is None]
+        if len(live) == 0:
+            return states
+
+        timings = {}
+        with timed(timings, "pos_tag"):
+            tagged = tag_documents([state.sentences for state in live])
+        total = sum(len(state.sentences) for state in live)
+        for state, tagged_sentences in zip(live, tagged):
+            share = 1.0 / len(live)
+            if total > 0:
+                share = float(len(state.sentences)) / total
+            state.timings["pos_tag"] = timings["pos_tag"] * share
+            self._analyse_tagged(state, tagged_sentences)
+        return states
+
+    def _analyse_tagged(self, state, tagged_sentences):
+        content = state.content
+
         # Headline extraction 
         h_counter = 6
         headline = None
         while h_counter > 0:
-            tag = "h%d" % (h_counter,)
             found = False 
-            for node in html.findAll(tag):
-                if node.text in content:
-                    headline = node.text 
+            for text in state.headings[h_counter]:
+                if text in content:
+                    headline = text 
                     found = True 
                     break 
             if found:
                 break
             h_counter -= 1
+        state.headline = headline
 
-        # Run keyword extraction 
-        keywords = self.ex(content)
+        # Run keyword extraction (the sentences were tokenized and tagged
+        # once, for both keyword extraction and NNPs)
+        with timed(state.timings, "terms"):
+            keywords = self.ex.extract(topia_terms(tagged_sentences))
         kset     = KeywordSet(self.stop_list)
         nnp_sets_scored = set([])
 
@@ -295,9 +637,7 @@ class CrawlProcessor(object):
         nnp_adj = set([])
         nnp_set = set([])
         nnp_vector = []
-        for sentence in sent_tokenize(content):
-            text = nltk.word_tokenize(sentence)
-            pos  = nltk.pos_tag(text)
+        for pos in tagged_sentences:
             pos_groups = itertools.groupby(pos, lambda x: x[1])
             for k, g in pos_groups:
                 if k != 'NNP':
@@ -359,33 +699,144 @@ class CrawlProcessor(object):
             except ValueError as ex:
                 logging.error(ex)
 
-        # Resolve keyword identifiers
-        keyword_resolution_worker = KeywordResolutionWorker(set([k.word for k in keywords]), self.redis_kw)
-        keyword_resolution_worker.start()
-            
+        state.keywords = set(kset)
+        state.keyword_words = set([k.word for k in keywords])
+        state.nnp_adj = nnp_adj
+
         # Run sentiment analysis
+        with timed(state.timings, "classify"):
+            state.features, state.trace = self._cached("classify", content, pysen.__VERSION__, self._classify, content)
+
+        return state
+
+    def _classify(self, content):
         trace = []
-        features = self.cls.classify(worker_req_thread.result, trace) 
+        features = self.cls.classify(content, trace)[0:7]
+
+        # Keep plain text rather than pysen's objects
+        plain = []
+        for sentence, score, phrase_trace in trace:
+            phrases = [(phrase.get_text(), prob, phrase_score, label) for phrase, prob, phrase_score, label in phrase_trace]
+            plain.append((sentence.text, score, phrases))
+        return features, plain
+
+    def persist_stage(self, state):
+        # Writes the Article and everything derived from it to the session,
+        # returns the Article's id or False if it was rejected
+
+        if state.denied:
+            return False
+
+        domain = self._session.query(Domain).get(state.domain_id)
+        assert domain is not None
+
+        # Build database objects 
+        path   = self.ac.get_path_fromurl(state.url)
+        article = Article(path, state.date_crawled, state.crawl_id, domain, state.status)
+        self._session.add(article)
+        self._timed.append((article, state))
+        # The Document needs the Article's id
+        self._session.flush()
+
+        if state.finished:
+            return False
+
+        if state.duplicate_of is not None:
+            original = self._session.query(Document).get(state.duplicate_of)
+            if original is not None:
+                logging.info("%s: near-duplicate of document %d", state.url, state.duplicate_of)
+                article.status = "Duplicate"
+                self._session.add(ArticleDuplicate(article, original))
+                self.dedup.record_duplicate(len(state.content))
+                self._session.flush()
+                return article.id
+
+            # The original's gone, so analyse this one after all
+            state.duplicate_of = None
+            state = self.analyse_stage(self._filter_boilerplate(state))
+            if state.finished:
+                article.status = state.status
+                return False
+
+        content = state.content
+        kset = KeywordSet(self.stop_list)
+        kset.keywords = state.keywords
+        nnp_adj = state.nnp_adj
+        date_dict = state.date_dict
+
+        # Resolve keyword identifiers
+        keyword_resolution_worker = KeywordResolutionWorker(state.keyword_words, self.redis_kw, self._engine)
+        keyword_resolution_worker.start()
+
         label, length, classified, pos_sentences, neg_sentences,\
-        pos_phrases, neg_phrases  = features[0:7]        
+        pos_phrases, neg_phrases  = state.features
 
         # Convert Pysen's model into database models
         try:
-            doc = Document(article.id, label, length, pos_sentences, neg_sentences, pos_phrases, neg_phrases, headline)
+            doc = Document(article.id, label, length, pos_sentences, neg_sentences, pos_phrases, neg_phrases, state.headline)
         except ValueError as ex:
             logging.error(ex)
             logging.error("Skipping this document...")
             article.status = "ClassificationError"
+            keyword_resolution_worker.join()
             return False
 
         self._session.add(doc)
+        extracted_phrases = self._add_sentences(doc, state.trace, state.text_nodes)
+
+        # Wait for keyword resolution to finish
+        with timed(state.timings, "keywords"):
+            keyword_resolution_worker.join()
+        keyword_mapping = keyword_resolution_worker.out_keywords
+        self._record_keyword_resolution(keyword_resolution_worker)
+
+        # Associate extracted keywords with phrases, the rows are written
+        # by id once the Phrases have theirs
+        keyword_phrases = self._keyword_phrases(kset.convert_ids(keyword_mapping), extracted_phrases)
+
+        # Build date objects
+        self._add_dates(doc, date_dict, content)
+
+        # Process links
+        with timed(state.timings, "links"):
+            self._persist_links(state, doc)
+
+        logging.debug("Domain: %s", domain)
+        logging.debug("Path: %s", path)
+        article.status = state.status
+
+        # Commit happens in process_record / process_batch
+        self._session.flush()
+
+        # Keyword incidences and the keyword adjacency list, by id
+        incidences = set((keyword_id, p_obj.id) for keyword_id, p_obj in keyword_phrases)
+        if len(incidences) > 0:
+            self._session.execute(KeywordIncidence.__table__.insert(),
+                [{"keyword_id": keyword_id, "phrase_id": phrase_id} for keyword_id, phrase_id in incidences])
+        adjacencies = kset.convert_adj_ids(nnp_adj, keyword_mapping)
+        if len(adjacencies) > 0:
+            self._session.execute(KeywordAdjacency.__table__.insert(),
+                [{"doc_id": doc.id, "key1_id": i, "key2_id": j} for i, j in adjacencies])
+
+        # Software involvement records, by id in one INSERT
+        self._session.execute(SoftwareInvolvementRecord.__table__.insert(), self.versions.involvements(doc.id, [
+            (self.__VERSION__, "Processed"),
+            (pydate.__VERSION__, "Dated"),
+            (pysen.__VERSION__, "Classified"),
+            (state.extractor_version, "Extracted"),
+        ]))
+        self.dedup.add(state.fingerprint, doc.id)
+        self.dedup.record_processed(timeit.default_timer() - state.started)
+        return article.id
+
+    def _add_sentences(self, doc, trace, text_nodes):
+        # Adds the classifier's sentences and phrases to doc, returns
+        # (phrase text, Phrase) for each phrase
         extracted_phrases = set([])
+        text_index = TextNodeIndex(text_nodes)
         for sentence, score, phrase_trace in trace:
-            sentence_type = "Unknown"
-            for node in html.findAll(text=True):
-                if sentence.text in node.strip():
-                    sentence_type = node.parent.name.upper()
-                    break
+            tag = text_index.get_tag(sentence)
+            sentence_type = tag.upper() if tag is not None else "Unknown"
 
             if sentence_type not in ["H1", "H2", "H3", "H4", "H5", "H6", "P", "Unknown"]:
                 sentence_type = "Other"
@@ -398,35 +849,28 @@ class CrawlProcessor(object):
                 p = Phrase(s, score, prob, label)
                 self._session.add(p)
                 extracted_phrases.add((phrase, p))
+        return extracted_phrases
 
-        # Wait for keyword resolution to finish
-        keyword_resolution_worker.join()
-        keyword_mapping = keyword_resolution_worker.out_keywords
-
-        # Associate extracted keywords with phrases
-        keyword_objects, short_keywords = kset.convert(keyword_mapping, self.kwc)
-        for k in keyword_objects:
-            self._session.merge(k)
+    def _keyword_phrases(self, keyword_ids, extracted_phrases):
+        # (keyword id, Phrase) for each keyword in each phrase
+        keyword_matcher = MultiPatternMatcher(keyword_ids)
+        keyword_phrases = []
         for p, p_obj in extracted_phrases:
-            for k in keyword_objects:
-                if k.word in p.get_text():
-                    nk = KeywordIncidence(k, p_obj)
-
-        # Save the keyword adjacency list
-        for i, j in kset.convert_adj_tuples(nnp_adj, keyword_mapping, self.kwc):
-            self._session.merge(i)
-            self._session.merge(j)
-            kwa = KeywordAdjacency(i, j, doc)
-            self._session.add(kwa)
-
-        # Build date objects
+            for word in keyword_matcher.search(p):
+                keyword_phrases.append((keyword_ids[word], p_obj))
+        return keyword_phrases
+
+    def _add_dates(self, doc, date_dict, content):
+        # Adds the dates pydate found which appear in content to doc
+        date_matcher = MultiPatternMatcher(rec["text"] for rec in date_dict.values() if "dates" in rec)
+        dates_in_content = date_matcher.search(content)
         for key in date_dict:
             rec  = date_dict[key]
             if "dates" not in rec:
                 logging.error("OK: 'dates' is not in a pydate result record.")
                 continue
             dlen = len(rec["dates"])
-            if rec["text"] not in content:
+            if rec["text"] not in dates_in_content:
                 logging.debug("'%s' is not in %s", rec["text"], content)
                 continue
             if dlen > 1:
@@ -444,15 +888,27 @@ class CrawlProcessor(object):
             else:
                 logging.error("'dates' in a pydate result set contains no records.")
 
-        # Process links
-        for link in html.findAll('a'):
-            if not link.has_attr("href"):
-                logging.debug("skipping %s: no href", link)
+    def _record_keyword_resolution(self, worker):
+        self.keyword_counters["articles"] += 1
+        self.keyword_counters["keywords"] += len(worker.in_keywords)
+        self.keyword_counters["round_trips"] += worker.round_trips
+        if self.keyword_counters["articles"] % REPORT_EVERY == 0:
+            logging.info("Keyword resolution: %.1f keywords and %.2f round trips per article",
+                float(self.keyword_counters["keywords"]) / self.keyword_counters["articles"],
+                float(self.keyword_counters["round_trips"]) / self.keyword_counters["articles"])
+
+    def _persist_links(self, state, doc):
+        anchor_matcher = MultiPatternMatcher(node for link, nodes in state.anchors for node in nodes)
+        anchors_in_body = anchor_matcher.search(state.body)
+        absolute = []
+        for link, nodes in state.anchors:
+            if link is None:
+                logging.debug("skipping %s: no href", nodes)
                 continue
 
             process = True 
-            for node in link.findAll(text=True):
-                if node not in worker_req_thread.result:
+            for node in nodes:
+                if node not in anchors_in_body:
                     process = False 
                     break 
             
@@ -460,25 +916,9 @@ class CrawlProcessor(object):
                 logging.debug("skipping %s because it's not in the body text", link)
                 break
 
-            href, junk, junk = link["href"].partition("#")
+            href, junk, junk = link.partition("#")
             if "http://" in href:
-                try:
-
-                    domain_id = None 
-                    domain_key = self.dc.get_Domain_key(href)
-                    while domain_id is None:
-                        domain_id = self.drw.get_domain(domain_key)
-
-                    assert domain_id is not None
-                    href_domain = self._session.query(Domain).get(domain_id)
-                except ValueError as ex:
-                    logging.error(ex)
-                    logging.error("Skipping this link")
-                    continue
-                href_path   = self.ac.get_path_fromurl(href)
-                lnk = AbsoluteLink(doc, href_domain, href_path)
-                self._session.add(lnk)
-                logging.debug("Adding: %s", lnk)
+                absolute.append((self.dc.get_Domain_key(href), self.ac.get_path_fromurl(href)))
             else:
                 href_path  = href 
                 try:
@@ -490,151 +930,20 @@ class CrawlProcessor(object):
                 self._session.add(lnk)
                 logging.debug("Adding: %s", lnk)
 
-        # Construct software involvment records
-        self_sir = SoftwareInvolvementRecord(self.swc.get_SoftwareVersion_fromstr(self.__VERSION__), "Processed", doc)
-        date_sir = SoftwareInvolvementRecord(self.swc.get_SoftwareVersion_fromstr(pydate.__VERSION__), "Dated", doc)
-        clas_sir = SoftwareInvolvementRecord(self.swc.get_SoftwareVersion_fromstr(pysen.__VERSION__), "Classified", doc)
-        extr_sir = SoftwareInvolvementRecord(self.swc.get_SoftwareVersion_fromstr(worker_req_thread.version), "Extracted", doc)
-
-        for sw in [self_sir, date_sir, clas_sir, extr_sir]:
-            self._session.merge(sw, load=True)
-
-        logging.debug("Domain: %s", domain)
-        logging.debug("Path: %s", path)
-        article.status = status
-
-        # Commit to database, return True on success
-        try:
-            self._session.commit()
-        except OperationalError as ex:
-            logging.error(ex)
-            self._session.rollback()
-            return None
-
-        return article.id
+        # Resolve every absolute link's domain in one go
+        domain_ids = self.domains.get_many(domain_key for domain_key, href_path in absolute)
+        for domain_key, href_path in absolute:
+            if domain_key not in domain_ids:
+                logging.error("Can't resolve domain %s, skipping this link", domain_key)
+                continue
+            try:
+                lnk = AbsoluteLink(doc, domain_ids[domain_key], href_path)
+            except ValueError as ex:
+                logging.error(ex)
+                logging.error("Skipping this link")
+                continue
+            self._session.add(lnk)
+            logging.debug("Adding: %s", lnk)
 
     def finalize(self):
         self._session.commit()
-
-class DomainResolutionWorker(object):
-
-    def __init__(self, session, redis):
-        self.session = session
-        self.redis   = redis 
-
-    def get_domain(self, domain):
-
-        # Check if the domain exists in redis
-        _id = self.redis.get(domain)
-        if _id is not None:
-            logging.info(("Redis", domain, _id))
-            return int(_id)
-
-        session = self.session
-
-        # Check if the domain exists
-        logging.info("DomainResolutionWorker: checking %s..." % domain)
-        sql = "SELECT id FROM domains WHERE `key` = '%s'" % (domain) 
-        for _id, in session.execute(sql):
-            logging.info(("DB", domain, _id))
-            self.redis.set(domain, _id)
-            return _id 
-
-        # If it doesn't, create it
-        sql = "INSERT IGNORE INTO domains (`key`,`date`) VALUES ('%s', NOW())"
-        logging.debug(sql, domain)
-        logging.info("DomainResolutionWorker: inserting %s..." % domain)
-        try:
-            session.execute(sql % (domain,))
-            session.commit()
-        except Exception as ex:
-            logging.error(str(ex))
-            logging.error(type(ex))
-        return None 
-
-class KeywordResolutionWorker(threading.Thread):
-
-    def __init__(self, keywords, redis_server):
-        self.in_keywords  = keywords
-        self.out_keywords = {}
-        threading.Thread.__init__(self)
-        logging.info("Keyword resolution: opening DB...")
-        host = os.environ["SENT_DB_URL"]
-        user = os.environ["SENT_DB_USER"]
-        pswd = os.environ["SENT_DB_PASS"]
-        self.db_con = mdb.connect(host, user, pswd, "sentimentron")
-        self.r  = redis_server
-
-    def run(self):
-
-        con = self.db_con
-        r = self.r 
-
-        # Try and retrieve some of the keywords from the redis server
-        db_resolve = set([])
-        for key in self.in_keywords:
-            _id = r.get(key)
-            if _id is None:
-                db_resolve.add(key)
-            else:
-                logging.debug(('Redis', key, _id))
-                self.out_keywords[key] = int(_id)
-
-        # Create the 1st-phase query
-        sql = "INSERT IGNORE INTO keywords (`word`) VALUES (%s)"
-
-        cur = con.cursor()
-        logging.info("Keyword resolution: 1st-phase INSERT")
-        #logging.debug(self.in_keywords)
-        cur.executemany(sql, [(k,) for k in db_resolve])
-        con.commit()
-
-        # Now the 2nd-phase, getting the IDs
-        sql = "SELECT id FROM keywords WHERE `word` = %s"
-        for key in db_resolve:
-            cur.execute(sql, (key,))
-            identifier, = cur.fetchone()
-            thing = ('DB', key, identifier)
-            logging.debug(thing)
-            r.set(key, identifier)
-            self.out_keywords[key] = identifier
-
-class BoilerPipeWorker(threading.Thread):
-
-    def __init__(self, body_text):
-        self.orig = body_text 
-        self.result = None 
-        self.version = None
-        threading.Thread.__init__(self)
-
-    def run(self):
-        import requests
-        post = {"charset": "UTF-8", "content": self.orig, "method":"default"}
-        r = requests.post(os.environ["BOILERPIPE_URL"], data = post)
-        r.raise_for_status()
-
-        try:
-            parsed  = etree.fromstring(r.text)
-        except Exception as ex:
-            logging.critical("Failed to parse: %s (%s)", r.text, ex)
-            return 
-
-        server_node = parsed.find("ServerInfo")
-        if server_node is None:
-            raise ValueError("No ServerInfo")
-
-        self.version = "Unknown"
-        version = server_node.find("Version")
-        if version is None:
-            raise ValueError("Couldn't find version information: %s" % (r.text,))
-        self.version = version.text
-
-        logging.debug(parsed)
-        if parsed.find("ExtractionFailureResponse") is not None:
-            return None
-
-        content = parsed.find("Response")
-        if content is None:
-            raise ValueError(("Couldn't find response", r.text))
-
-        self.result = content.text.encode('ascii','ignore') 
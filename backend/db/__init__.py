@@ -8,3 +8,4 @@ from crawl import CertainDate, AmbiguousDate
 from crawl import KeywordAdjacency, RelativeLink, AbsoluteLink
 from crawl import UserQuery, UserQueryKeywordRecord, UserQueryDomainRecord, UserQueryArticleRecord
 from crawl import RawArticle, RawArticleResult, RawArticleResultLink
+from crawl import ArticleDuplicate
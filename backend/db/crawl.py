@@ -677,17 +677,22 @@ class AbsoluteLink(Base):
         return path
 
     def __str__(self):
+        if self.domain is None:
+            return "AbsoluteLink (%s/%s)" % (self.domain_id, self.path)
         return "AbsoluteLink (%s/%s)" % (self.domain.key, self.path)
 
     def __init__(self, document, domain, path): 
+        # domain can also be a Domain's id, which saves loading it
         if not isinstance(document, Document):
             raise TypeError(("document: Not a Document", document, type(document)))
 
-        if not isinstance(domain, Domain):
-            raise TypeError(("domain: Not a Domain", domain, type(domain)))
-
         self.path     = path 
-        self.domain   = domain
+        if isinstance(domain, Domain):
+            self.domain = domain
+        elif isinstance(domain, (int, long)):
+            self.domain_id = domain
+        else:
+            raise TypeError(("domain: Not a Domain or id", domain, type(domain)))
         self.document = document 
 
 
@@ -755,12 +760,16 @@ class Document(Base):
         else:
             self.parent = parent 
 
+        self.headline = headline
+        self.set_classification(label, length, pos_sentences, neg_sentences, pos_phrases, neg_phrases)
+
+    def set_classification(self, label, length, pos_sentences, neg_sentences, pos_phrases, neg_phrases):
+
         self.length = length 
         self.pos_phrases   = pos_phrases
         self.neg_phrases   = neg_phrases
         self.pos_sentences = pos_sentences
         self.neg_sentences = neg_sentences
-        self.headline = headline
 
         # Set the label
         if label == 1:
@@ -782,7 +791,7 @@ class Article(Base):
     inserted= Column(DateTime, nullable = False)
     crawl_id= Column(Integer, ForeignKey("crawl_files.id"), nullable = True)
     domain_id = Column(Integer, ForeignKey("domains.id"), nullable = False)
-    status  = Column(Enum("Processed", "NoDates", "NoContent", "UnsupportedType", "ClassificationError", "LanguageError", "OtherError"), nullable = False)
+    status  = Column(Enum("Processed", "NoDates", "NoContent", "UnsupportedType", "ClassificationError", "LanguageError", "OtherError", "Duplicate", "Truncated", "TooLarge"), nullable = False)
 
     documents = relationship("Document", backref="parent")
 
@@ -817,6 +826,29 @@ class Article(Base):
         self.inserted = datetime.now()
         self.domain = domain
 
+class ArticleDuplicate(Base):
+
+    # Points an Article whose body was a near-duplicate at the Document
+    # holding the analysis it shares
+
+    __tablename__ = 'article_duplicates'
+
+    article_id  = Column(Integer, ForeignKey('articles.id'), primary_key = True)
+    document_id = Column(Integer, ForeignKey('documents.id'), nullable = False)
+
+    article  = relationship("Article")
+    document = relationship("Document")
+
+    def __init__(self, article, document):
+        if not isinstance(article, Article):
+            raise TypeError(("article: Not an Article", article, type(article)))
+
+        if not isinstance(document, Document):
+            raise TypeError(("document: Not a Document", document, type(document)))
+
+        self.article  = article
+        self.document = document
+
 class ArticleController(DBBackedController):
 
     def __init__(self, engine, session = None):
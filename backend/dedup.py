@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+#
+# Near-duplicate article detection
+#
+# Extracted bodies are fingerprinted with a 64-bit SimHash over word
+# shingles. The fingerprints live in an LSH index in redis, split into
+# BANDS bands so that anything within MAX_DISTANCE bits of a stored
+# fingerprint shares at least one band with it.
+#
+# Each band is a sorted set scored by when the fingerprint was added, so
+# articles are only matched against those seen in the last window
+# seconds. Older entries are trimmed whenever a band is added to, and a
+# band nothing's been added to for a window expires.
+#
+
+import hashlib
+import logging
+import time
+
+from collections import Counter
+
+SIMHASH_BITS = 64
+SHINGLE_WIDTH = 3
+MIN_WORDS = 50       # shorter bodies are never treated as duplicates
+BANDS = 4
+MAX_DISTANCE = 3     # must be < BANDS for the banding to find everything
+DUPLICATE_WINDOW = 30 * 24 * 60 * 60 # seconds
+
+# Log the counters every this many articles
+REPORT_EVERY = 500
+
+BAND_BITS = SIMHASH_BITS / BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+def simhash(text, width=SHINGLE_WIDTH):
+    words = text.lower().split()
+    if len(words) < MIN_WORDS:
+        return None
+
+    weights = [0] * SIMHASH_BITS
+    shingles = Counter(u" ".join(words[i:i+width]) for i in range(len(words) - width + 1))
+    for shingle, count in shingles.iteritems():
+        if isinstance(shingle, unicode):
+            shingle = shingle.encode('utf-8')
+        h = int(hashlib.md5(shingle).hexdigest()[:16], 16)
+        for bit in range(SIMHASH_BITS):
+            if h & (1 << bit):
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+
+    ret = 0
+    for bit in range(SIMHASH_BITS):
+        if weights[bit] > 0:
+            ret |= 1 << bit
+    return ret
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+class SimHashIndex(object):
+
+    def __init__(self, redis, max_distance=MAX_DISTANCE, window=DUPLICATE_WINDOW):
+        self.redis = redis
+        self.max_distance = max_distance
+        self.window = window
+        self.counters = Counter()
+
+    def _band_keys(self, fingerprint):
+        # simhash2, since the simhash bands were unbounded plain sets
+        return ["simhash2:%d:%x" % (band, (fingerprint >> (band * BAND_BITS)) & BAND_MASK) for band in range(BANDS)]
+
+    def find(self, fingerprint):
+        # Returns the Document id of the closest near-duplicate, or None
+        self.counters["checked"] += 1
+        if self.counters["checked"] % REPORT_EVERY == 0:
+            self.log_counters()
+        if fingerprint is None:
+            return None
+
+        since = time.time() - self.window
+        pipe = self.redis.pipeline(transaction=False)
+        for key in self._band_keys(fingerprint):
+            pipe.zrangebyscore(key, since, "+inf")
+
+        best, best_distance = None, None
+        for members in pipe.execute():
+            for member in members:
+                other, document_id = member.split(":")
+                distance = hamming_distance(fingerprint, int(other, 16))
+                if distance > self.max_distance:
+                    continue
+                if best_distance is None or distance < best_distance:
+                    best, best_distance = int(document_id), distance
+        return best
+
+    def add(self, fingerprint, document_id):
+        if fingerprint is None:
+            return
+        member = "%x:%d" % (fingerprint, document_id)
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for key in self._band_keys(fingerprint):
+            # zadd's argument order differs between redis-py versions
+            pipe.execute_command("ZADD", key, now, member)
+            pipe.zremrangebyscore(key, "-inf", now - self.window)
+            pipe.expire(key, self.window)
+        pipe.execute()
+
+    def record_duplicate(self, body_bytes):
+        self.counters["duplicates"] += 1
+        self.counters["bytes_skipped"] += body_bytes
+
+    def record_processed(self, seconds):
+        self.counters["processed"] += 1
+        self.counters["processing_ms"] += int(seconds * 1000)
+
+    def log_counters(self):
+        # Time saved is estimated from the mean time taken by the articles
+        # which did go through the rest of the pipeline
+        processed = self.counters["processed"]
+        mean = 0.0
+        if processed > 0:
+            mean = self.counters["processing_ms"] / 1000.0 / processed
+        logging.info("SimHashIndex: %d checked, %d duplicates, %.1f KiB of body text skipped, ~%.1fs of processing saved",
+            self.counters["checked"], self.counters["duplicates"], self.counters["bytes_skipped"] / 1024.0,
+            mean * self.counters["duplicates"])
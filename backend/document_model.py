@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+#
+# Compact document model: the headings, anchors and text nodes which
+# _process_record reads from a page, collected in a single walk
+#
+
+import logging
+import re
+
+from lxml import etree
+import lxml.html
+from bs4 import BeautifulSoup
+
+HEADING_TAGS = dict(("h%d" % (level,), level) for level in range(1, 7))
+
+# Pages past MAX_PAGE_BYTES are cut short, and pages with more than
+# MAX_DOM_NODES elements aren't parsed or walked at all
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+MAX_DOM_NODES = 50000
+
+START_TAG_RE = re.compile(r"<[a-zA-Z]")
+
+def truncate(content, max_bytes=MAX_PAGE_BYTES):
+    # Returns the content and whether it was cut, at the last tag
+    # boundary inside max_bytes so no tag is split
+    if max_bytes is None or len(content) <= max_bytes:
+        return content, False
+    cut = content.rfind("<", 0, max_bytes)
+    if cut <= 0:
+        cut = max_bytes
+    return content[:cut], True
+
+def over_node_budget(content, max_nodes=MAX_DOM_NODES):
+    # Counts start tags without parsing, so oversize pages are rejected
+    # before they're built into a tree or sent to an extractor
+    if max_nodes is None:
+        return False
+    return len(START_TAG_RE.findall(content)) > max_nodes
+
+class DocumentModel(object):
+
+    def __init__(self):
+        self.has_body   = False
+        self.too_large  = False # over the DOM node budget, nothing else is set
+        self.headings   = dict((level, []) for level in HEADING_TAGS.values())
+        self.anchors    = []    # (href or None, [text nodes])
+        self.text_nodes = []    # (text, parent tag name), in document order
+        self.tree = None        # lxml root, for extractors which can share it
+        self._soup = None
+        self._content = None    # what soup is built from, if it hasn't been
+
+    @property
+    def soup(self):
+        # BeautifulSoup tree, which pydate only accepts. In lxml mode it's
+        # a second parse, so it's only built if dates aren't cached.
+        if self._soup is None and self._content is not None:
+            self._soup = BeautifulSoup(self._content, "lxml")
+            self._content = None
+        return self._soup
+
+    @classmethod
+    def from_soup(cls, content, max_nodes=None):
+        # The original path: BeautifulSoup with whichever parser it picks
+        model = cls()
+        html = BeautifulSoup(content)
+        if html is not None and max_nodes is not None and len(html.findAll(True, limit=max_nodes+1)) > max_nodes:
+            model.too_large = True
+            return model
+        model._soup = html
+        if html is None or html.body is None:
+            return model
+        model.has_body = True
+
+        for tag, level in HEADING_TAGS.iteritems():
+            model.headings[level] = [node.text for node in html.findAll(tag)]
+        for link in html.findAll('a'):
+            href = None
+            if link.has_attr("href"):
+                href = link["href"]
+            model.anchors.append((href, link.findAll(text=True)))
+        model.text_nodes = [(node, node.parent.name) for node in html.findAll(text=True)]
+        return model
+
+    @classmethod
+    def from_lxml(cls, content, max_nodes=None):
+        # Fast path: parse once with lxml and walk the tree once
+        model = cls()
+        try:
+            root = lxml.html.document_fromstring(content)
+        except (etree.ParserError, ValueError) as ex:
+            logging.error(ex)
+            return model
+        if max_nodes is not None and sum(1 for node in root.iter()) > max_nodes:
+            model.too_large = True
+            return model
+        model.tree = root
+        model._content = content
+        model.has_body = root.find("body") is not None
+        if not model.has_body:
+            return model
+
+        # Headings and anchors which are currently open; every text node
+        # is also appended to each of them
+        collecting = []
+
+        def add_text(text, tag):
+            if not text:
+                return
+            model.text_nodes.append((text, tag))
+            for node, pieces in collecting:
+                pieces.append(text)
+
+        for event, node in etree.iterwalk(root, events=("start", "end", "comment", "pi")):
+            parent = node.getparent()
+            parent_tag = None
+            if parent is not None:
+                parent_tag = parent.tag
+
+            if event in ("comment", "pi"):
+                # Comments and processing instructions belong to their parent
+                add_text(node.text, parent_tag)
+                add_text(node.tail, parent_tag)
+                continue
+
+            if event == "start":
+                if node.tag in HEADING_TAGS or node.tag == "a":
+                    collecting.append((node, []))
+                add_text(node.text, node.tag)
+                continue
+
+            if len(collecting) > 0 and collecting[-1][0] is node:
+                node, pieces = collecting.pop()
+                if node.tag == "a":
+                    model.anchors.append((node.get("href"), pieces))
+                else:
+                    model.headings[HEADING_TAGS[node.tag]].append(u"".join(pieces))
+            if parent is not None:
+                add_text(node.tail, parent_tag)
+
+        return model
+
+PARSERS = {
+    "soup": DocumentModel.from_soup,
+    "lxml": DocumentModel.from_lxml,
+}
+
+def parse_document(content, mode="soup", max_nodes=None, precheck=True):
+    # Callers which have already run over_node_budget pass precheck=False.
+    # The parsers still count the nodes they build, which is exact.
+    if mode not in PARSERS:
+        raise ValueError(("Unknown parse mode", mode))
+    if precheck and over_node_budget(content, max_nodes):
+        model = DocumentModel()
+        model.too_large = True
+        return model
+    return PARSERS[mode](content, max_nodes)
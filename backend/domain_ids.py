@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+#
+# Domain key => id service
+#
+# Ids come from a bounded in-process LRU, then redis, then MySQL. A miss
+# on a single key is one upsert which returns the id whether or not the
+# row already existed, so nothing has to retry until the row appears.
+#
+
+import logging
+
+from collections import Counter
+
+from lru import LRUCache
+from upsert import upsert_id
+
+LRU_SIZE = 50000
+
+# Log the counters every this many lookups
+REPORT_EVERY = 5000
+
+UPSERT_SQL = "INSERT INTO domains (`key`,`date`) VALUES (:key, NOW()) ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)"
+INSERT_SQL = "INSERT IGNORE INTO domains (`key`,`date`) VALUES (:key, NOW())"
+SELECT_SQL = "SELECT `key`, id FROM domains WHERE `key` IN (%s)"
+
+class DomainIdService(object):
+
+    def __init__(self, session, redis, lru_size=LRU_SIZE):
+        # session should be its own, since every new domain is committed
+        # straight away
+        self.session = session
+        self.redis = redis
+        self.lru = LRUCache(lru_size)
+        self.counters = Counter()
+
+    def _count_lookups(self, count):
+        before = self.counters["lookups"]
+        self.counters["lookups"] += count
+        if before // REPORT_EVERY != self.counters["lookups"] // REPORT_EVERY:
+            self.log_counters()
+
+    def get(self, key):
+        self._count_lookups(1)
+        _id = self.lru.get(key)
+        if _id is not None:
+            self.counters["lru_hits"] += 1
+            return _id
+
+        _id = self.redis.get(key)
+        if _id is not None:
+            self.counters["redis_hits"] += 1
+            _id = int(_id)
+            self.lru.set(key, _id)
+            return _id
+
+        self.counters["db_lookups"] += 1
+        _id = upsert_id(self.session, UPSERT_SQL, {"key": key})
+
+        self.redis.set(key, _id)
+        self.lru.set(key, _id)
+        return _id
+
+    def get_many(self, keys):
+        # Returns {key: id} for every key which could be resolved, using
+        # one MGET, then for the misses one SELECT, one INSERT IGNORE and
+        # one more SELECT, and one MSET
+        keys = list(set(keys))
+        self._count_lookups(len(keys))
+
+        ret, misses = {}, []
+        for key in keys:
+            _id = self.lru.get(key)
+            if _id is None:
+                misses.append(key)
+            else:
+                ret[key] = _id
+        self.counters["lru_hits"] += len(ret)
+        if len(misses) == 0:
+            return ret
+
+        keys, misses = misses, []
+        for key, _id in zip(keys, self.redis.mget(keys)):
+            if _id is None:
+                misses.append(key)
+            else:
+                ret[key] = int(_id)
+                self.lru.set(key, int(_id))
+                self.counters["redis_hits"] += 1
+        if len(misses) == 0:
+            return ret
+
+        self.counters["db_lookups"] += len(misses)
+        found = self._select(misses)
+        missing = [key for key in misses if key not in found]
+        if len(missing) > 0:
+            try:
+                self.session.execute(INSERT_SQL, [{"key": key} for key in missing])
+                self.session.commit()
+            except Exception as ex:
+                logging.error("Can't insert %d domains: %s", len(missing), ex)
+                self.session.rollback()
+            found.update(self._select(missing))
+
+        if len(found) > 0:
+            self.redis.mset(found)
+        for key, _id in found.iteritems():
+            self.lru.set(key, _id)
+        ret.update(found)
+        return ret
+
+    def _select(self, keys):
+        params = dict(("k%d" % (i,), key) for i, key in enumerate(keys))
+        sql = SELECT_SQL % (", ".join(":%s" % (p,) for p in params),)
+        # The key column's collation may not be case-sensitive
+        ids = dict((key.lower(), _id) for key, _id in self.session.execute(sql, params))
+        return dict((key, ids[key.lower()]) for key in keys if key.lower() in ids)
+
+    def log_counters(self):
+        logging.info("DomainIdService: %d lookups, %d LRU hits, %d redis hits, %d database lookups, %d cached",
+            self.counters["lookups"], self.counters["lru_hits"], self.counters["redis_hits"],
+            self.counters["db_lookups"], len(self.lru))
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+#
+# Main-content (boilerplate removal) extractors
+#
+# Every extractor exposes submit(content, tree=None), which returns a job
+# with join(), result (the extracted plain text, or None) and version
+# (recorded against the Document as the "Extracted" SoftwareVersion).
+#
+
+import logging
+import os
+import re
+import threading
+import time
+import Queue
+
+from lxml import etree
+import lxml.html
+import requests
+
+BOILERPIPE_POOL_SIZE = 8
+BOILERPIPE_TIMEOUT   = (5.0, 60.0) # (connect, read) seconds
+BOILERPIPE_RETRIES   = 3
+BOILERPIPE_BACKOFF   = 0.5         # seconds, doubled after each attempt
+
+class BoilerPipeError(Exception):
+    pass
+
+def parse_boilerpipe_response(text):
+    # Returns (version, result) from boilerpipe's XML envelope, result is
+    # None if the service couldn't extract anything
+    try:
+        parsed  = etree.fromstring(text)
+    except Exception as ex:
+        logging.critical("Failed to parse: %s (%s)", text, ex)
+        return None, None
+
+    server_node = parsed.find("ServerInfo")
+    if server_node is None:
+        raise ValueError("No ServerInfo")
+
+    version = server_node.find("Version")
+    if version is None:
+        raise ValueError("Couldn't find version information: %s" % (text,))
+    version = version.text
+
+    logging.debug(parsed)
+    if parsed.find("ExtractionFailureResponse") is not None:
+        return version, None
+
+    content = parsed.find("Response")
+    if content is None:
+        raise ValueError(("Couldn't find response", text))
+
+    return version, content.text.encode('ascii','ignore')
+
+class BoilerPipeRequest(object):
+
+    def __init__(self, body_text):
+        self.orig = body_text
+        self.result = None
+        self.version = None
+        self.error = None
+        self._done = threading.Event()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+class BoilerPipeClient(object):
+
+    # Shared client for the remote boilerpipe service: requests go over a
+    # keep-alive connection pool, at most pool_size are in flight at once,
+    # and failed connections, timeouts and 5xx responses are retried with
+    # exponential backoff.
+
+    def __init__(self, url=None, pool_size=BOILERPIPE_POOL_SIZE, timeout=BOILERPIPE_TIMEOUT,
+        retries=BOILERPIPE_RETRIES, backoff=BOILERPIPE_BACKOFF):
+
+        if url is None:
+            url = os.environ["BOILERPIPE_URL"]
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(pool_size):
+            t = threading.Thread(target=self._worker, name="BoilerPipeClient-%d" % (i,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, content):
+        req = BoilerPipeRequest(content)
+        self._queue.put(req)
+        return req
+
+    def submit_many(self, contents):
+        # Queue everything before waiting on anything, so a batch of
+        # articles shares the pool instead of going one at a time
+        return [self.submit(content) for content in contents]
+
+    def _worker(self):
+        while True:
+            req = self._queue.get()
+            try:
+                req.version, req.result = self._post(req.orig)
+            except Exception as ex:
+                logging.error("BoilerPipe request failed: %s", ex)
+                req.error = ex
+            finally:
+                req._done.set()
+
+    def _post(self, content):
+        post = {"charset": "UTF-8", "content": content, "method":"default"}
+        attempt = 0
+        while True:
+            try:
+                r = self._session.post(self.url, data = post, timeout = self.timeout)
+                if r.status_code >= 500:
+                    raise BoilerPipeError("HTTP %d from %s" % (r.status_code, self.url))
+                r.raise_for_status()
+                return parse_boilerpipe_response(r.text)
+            except (requests.ConnectionError, requests.Timeout, BoilerPipeError) as ex:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                logging.warning("BoilerPipe: %s, retrying in %.1fs", ex, delay)
+                time.sleep(delay)
+                attempt += 1
+
+class ExtractionResult(object):
+
+    # A job which has already finished, for in-process extractors.
+    # from_cache means the result's already in the stage cache.
+
+    def __init__(self, result, version, from_cache=False):
+        self.result  = result
+        self.version = version
+        self.from_cache = from_cache
+
+    def join(self, timeout=None):
+        pass
+
+class PreExtracted(object):
+
+    # Stands in for a remote extractor in processes which are only handed
+    # pages it's already extracted, so they needn't start a client
+
+    needs_tree = False
+
+    def submit(self, content, tree=None):
+        raise ValueError("Pages should arrive here already extracted")
+
+    def submit_many(self, contents):
+        return [self.submit(content) for content in contents]
+
+class BoilerPipeExtractor(object):
+
+    # Remote boilerpipe service at BOILERPIPE_URL, one client per process
+
+    needs_tree = False
+
+    def __init__(self, client=None):
+        if client is None:
+            client = BoilerPipeClient()
+        self.client = client
+
+    def submit(self, content, tree=None):
+        return self.client.submit(content)
+
+    def submit_many(self, contents):
+        return self.client.submit_many(contents)
+
+class DensityExtractor(object):
+
+    # In-process text-density / link-density extractor over lxml. Text
+    # blocks with enough words and few links are kept, and the output is
+    # restricted to the container holding most of the kept text.
+
+    __VERSION__ = "DensityExtractor-0.1"
+
+    needs_tree = True
+
+    BLOCK_TAGS   = frozenset(["p", "pre", "blockquote", "li", "td", "dd", "h1", "h2", "h3", "h4", "h5", "h6"])
+    HEADING_TAGS = frozenset(["h1", "h2", "h3", "h4", "h5", "h6"])
+    IGNORE_TAGS  = frozenset(["script", "style", "noscript", "nav", "header", "footer", "aside", "form", "iframe", "select", "button"])
+
+    MIN_WORDS = 10
+    MAX_LINK_DENSITY = 0.33
+
+    WHITESPACE = re.compile(r"\s+", re.UNICODE)
+
+    def submit(self, content, tree=None):
+        if tree is None:
+            try:
+                tree = lxml.html.document_fromstring(content)
+            except (etree.ParserError, ValueError) as ex:
+                logging.error(ex)
+                return ExtractionResult(None, self.__VERSION__)
+        return ExtractionResult(self.extract(tree), self.__VERSION__)
+
+    def submit_many(self, contents):
+        return [self.submit(content) for content in contents]
+
+    def _text(self, node):
+        return self.WHITESPACE.sub(u" ", node.text_content()).strip()
+
+    def _blocks(self, tree):
+        for node in tree.iter(tag=etree.Element):
+            if node.tag not in self.BLOCK_TAGS:
+                continue
+            ignored = False
+            for parent in node.iterancestors():
+                if parent.tag in self.IGNORE_TAGS or parent.tag in self.BLOCK_TAGS:
+                    ignored = True
+                    break
+            if ignored:
+                continue
+
+            text = self._text(node)
+            if len(text) == 0:
+                continue
+            link_chars = sum(len(self._text(a)) for a in node.iter("a"))
+            if float(link_chars) / len(text) > self.MAX_LINK_DENSITY:
+                continue
+            words = len(text.split())
+            if words < self.MIN_WORDS and node.tag not in self.HEADING_TAGS:
+                continue
+            yield node, text, words
+
+    def extract(self, tree):
+        blocks = list(self._blocks(tree))
+
+        # Score candidate containers by the number of words they hold,
+        # giving the grandparent half credit
+        scores = {}
+        for node, text, words in blocks:
+            if node.tag in self.HEADING_TAGS:
+                continue
+            parent = node.getparent()
+            if parent is None:
+                continue
+            scores[parent] = scores.get(parent, 0) + words
+            grandparent = parent.getparent()
+            if grandparent is not None:
+                scores[grandparent] = scores.get(grandparent, 0) + words / 2.0
+
+        if len(scores) == 0:
+            return None
+
+        best = max(scores, key=scores.get)
+        scope = best.getparent()
+        if scope is None:
+            scope = best
+
+        ret = []
+        for node, text, words in blocks:
+            container = best
+            if node.tag in self.HEADING_TAGS:
+                container = scope
+            for parent in node.iterancestors():
+                if parent is container:
+                    ret.append(text)
+                    break
+
+        if len(ret) == 0:
+            return None
+
+        return u"\n".join(ret).encode('ascii', 'ignore')
+
+EXTRACTORS = {
+    "boilerpipe": BoilerPipeExtractor,
+    "density": DensityExtractor,
+}
+
+def get_extractor(name="boilerpipe"):
+    if name not in EXTRACTORS:
+        raise ValueError(("Unknown extractor", name))
+    return EXTRACTORS[name]()
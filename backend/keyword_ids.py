@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+#
+# Keyword word => id resolution, through redis and then the database
+#
+
+import logging
+import threading
+
+# MySQL's INSERT IGNORE and the DB-API's %s placeholders, on other dialects
+INSERT_IGNORE = {"sqlite": "INSERT OR IGNORE"}
+PLACEHOLDERS = {"qmark": "?"}
+
+class KeywordResolutionWorker(threading.Thread):
+
+    # One MGET, then for the misses an INSERT IGNORE, a single
+    # SELECT ... IN and an MSET, over a connection from the engine's pool.
+    # The SQL follows the engine's dialect, so SQLite can stand in for
+    # MySQL.
+
+    def __init__(self, keywords, redis_server, engine):
+        self.in_keywords  = list(keywords)
+        self.out_keywords = {}
+        self.round_trips  = 0
+        threading.Thread.__init__(self)
+        self.engine = engine
+        self.r  = redis_server
+
+    def run(self):
+
+        r = self.r 
+        if len(self.in_keywords) == 0:
+            return
+
+        # Try and retrieve the keywords from the redis server
+        db_resolve = []
+        self.round_trips += 1
+        for key, _id in zip(self.in_keywords, r.mget(self.in_keywords)):
+            if _id is None:
+                db_resolve.append(key)
+            else:
+                logging.debug(('Redis', key, _id))
+                self.out_keywords[key] = int(_id)
+        if len(db_resolve) == 0:
+            return
+
+        found = {}
+        insert_ignore = INSERT_IGNORE.get(self.engine.dialect.name, "INSERT IGNORE")
+        mark = PLACEHOLDERS.get(self.engine.dialect.paramstyle, "%s")
+        con = self.engine.raw_connection()
+        try:
+            cur = con.cursor()
+            logging.info("Keyword resolution: inserting %d keywords", len(db_resolve))
+            cur.executemany("%s INTO keywords (`word`) VALUES (%s)" % (insert_ignore, mark), [(k,) for k in db_resolve])
+            con.commit()
+            self.round_trips += 2
+
+            sql = "SELECT `word`, id FROM keywords WHERE `word` IN (%s)" % (", ".join([mark] * len(db_resolve)),)
+            cur.execute(sql, db_resolve)
+            self.round_trips += 1
+            ids = dict((word.lower(), identifier) for word, identifier in cur.fetchall())
+            for key in db_resolve:
+                if key.lower() in ids:
+                    found[key] = ids[key.lower()]
+                    continue
+                # Matched some other way under the column's collation
+                cur.execute("SELECT id FROM keywords WHERE `word` = %s" % (mark,), (key,))
+                self.round_trips += 1
+                row = cur.fetchone()
+                if row is not None:
+                    found[key] = row[0]
+            cur.close()
+        finally:
+            con.close()
+
+        if len(found) > 0:
+            r.mset(found)
+            self.round_trips += 1
+        self.out_keywords.update(found)
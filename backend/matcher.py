@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+#
+# Multi-pattern substring matcher (Aho-Corasick)
+#
+
+from collections import deque
+
+class MultiPatternMatcher(object):
+
+    def __init__(self, patterns):
+        self.patterns = set(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out  = [frozenset()]
+
+        for pattern in self.patterns:
+            self._add(pattern)
+        self._link()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _add(self, pattern):
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(frozenset())
+                self._goto[state][char] = nxt
+            state = nxt
+        self._out[state] = self._out[state] | frozenset([pattern])
+
+    def _link(self):
+        # Breadth-first pass computing failure links, so each state also
+        # reports every pattern that is a suffix of its own
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].iteritems():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                if fail == nxt:
+                    fail = 0
+                self._fail[nxt] = fail
+                self._out[nxt] = self._out[nxt] | self._out[fail]
+
+    def search(self, text):
+        # Returns the set of patterns which occur anywhere in text,
+        # i.e. [p for p in patterns if p in text] in a single scan
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set(out[0])
+        remaining = len(self.patterns) - len(found)
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                before = len(found)
+                found.update(out[state])
+                remaining -= len(found) - before
+                if remaining == 0:
+                    break
+        return found
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+#
+# Tokenization and part-of-speech tagging shared by term extraction and
+# NNP mining, so each page is only tagged once
+#
+
+import nltk
+from nltk.tokenize import sent_tokenize
+
+try:
+    from nltk import pos_tag_sents
+except ImportError:
+    # NLTK 2.x
+    from nltk import batch_pos_tag as pos_tag_sents
+
+PLURAL_TAGS = frozenset(["NNS", "NNPS"])
+
+def split_sentences(content):
+    return sent_tokenize(content)
+
+def tag_sentences(sentences):
+    tokens = [nltk.word_tokenize(sentence) for sentence in sentences]
+    return pos_tag_sents(tokens)
+
+def tag_documents(documents):
+    # Tags the sentences of many documents in one call, returns one list
+    # of tagged sentences per document
+    tagged = tag_sentences([sentence for sentences in documents for sentence in sentences])
+    ret, pos = [], 0
+    for sentences in documents:
+        ret.append(tagged[pos:pos+len(sentences)])
+        pos += len(sentences)
+    return ret
+
+def tag_document(content):
+    # Returns one list of (word, tag) pairs per sentence
+    return tag_sentences(split_sentences(content))
+
+def preload():
+    # Pulls the punkt and tagger models into NLTK's resource cache
+    tag_document(u"Models are loaded once. Workers share them.")
+
+def normalize(word, tag):
+    # Rough stand-in for topia's lexicon-based plural normalization
+    if tag in PLURAL_TAGS and len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def topia_terms(tagged_sentences):
+    # Converts tagged sentences into the (term, tag, norm) list which
+    # topia.termextract's TermExtractor.extract consumes
+    return [[word, tag, normalize(word, tag)] for sentence in tagged_sentences for word, tag in sentence]
+
+def topia_tagger(content):
+    # Drop-in tagger for TermExtractor, so it never loads its own lexicon
+    return topia_terms(tag_document(content))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+#
+# Stage-pipelined processing engine
+#
+# Each stage has its own pool of worker processes, and stages are joined
+# by bounded queues, so a slow stage applies backpressure instead of
+# letting work pile up in memory. A monitor thread logs each stage's
+# utilisation and queue depth.
+#
+
+import logging
+import multiprocessing
+import threading
+import timeit
+
+DEFAULT_QUEUE_SIZE = 16
+REPORT_INTERVAL = 60 # seconds
+
+# Tells a stage worker to exit
+_STOP = "__stop__"
+
+class Stage(object):
+
+    def __init__(self, name, func, workers=1, initializer=None, on_error=None):
+        # func takes the previous stage's output and returns this stage's,
+        # returning None drops the item. When func raises, on_error(item)
+        # gives what's passed on instead, so a failure can still be
+        # recorded further down.
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.initializer = initializer
+        self.on_error = on_error
+
+        self.busy = multiprocessing.Value('d', 0.0)
+        self.done = multiprocessing.Value('l', 0)
+        self.failed = multiprocessing.Value('l', 0)
+
+def _stage_worker(stage, in_queue, out_queue):
+    if stage.initializer is not None:
+        stage.initializer()
+
+    while True:
+        item = in_queue.get()
+        if item == _STOP:
+            break
+
+        start = timeit.default_timer()
+        try:
+            result = stage.func(item)
+        except Exception as ex:
+            logging.exception("Stage %s failed: %s", stage.name, ex)
+            result = None
+            with stage.failed.get_lock():
+                stage.failed.value += 1
+            if stage.on_error is not None:
+                try:
+                    result = stage.on_error(item)
+                except Exception as ex:
+                    logging.exception("Stage %s couldn't pass on a failure: %s", stage.name, ex)
+        elapsed = timeit.default_timer() - start
+
+        with stage.busy.get_lock():
+            stage.busy.value += elapsed
+        with stage.done.get_lock():
+            stage.done.value += 1
+
+        if result is not None:
+            out_queue.put(result)
+
+class StagedPipeline(object):
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE, report_interval=REPORT_INTERVAL):
+        if len(stages) == 0:
+            raise ValueError("Needs at least one stage")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.queues = [multiprocessing.Queue(queue_size) for i in range(len(stages) + 1)]
+        self._processes = []
+        self._started = None
+        self._finished = threading.Event()
+
+    def run(self, iterable):
+        # Yields the last stage's outputs in completion order
+        self._started = timeit.default_timer()
+        for pos, stage in enumerate(self.stages):
+            procs = []
+            for i in range(stage.workers):
+                p = multiprocessing.Process(target=_stage_worker, name="%s-%d" % (stage.name, i),
+                    args=(stage, self.queues[pos], self.queues[pos+1]))
+                p.daemon = True
+                p.start()
+                procs.append(p)
+            self._processes.append(procs)
+
+        feeder = threading.Thread(target=self._feed, args=(iterable,), name="StagedPipeline-feeder")
+        feeder.daemon = True
+        feeder.start()
+
+        monitor = threading.Thread(target=self._monitor, name="StagedPipeline-monitor")
+        monitor.daemon = True
+        monitor.start()
+
+        out_queue = self.queues[-1]
+        while True:
+            item = out_queue.get()
+            if item == _STOP:
+                break
+            yield item
+
+        self._finished.set()
+        self.log_stats()
+
+    def _feed(self, iterable):
+        for item in iterable:
+            self.queues[0].put(item)
+
+        # Shut the stages down in order, once each one has drained
+        for pos, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                self.queues[pos].put(_STOP)
+            for p in self._processes[pos]:
+                p.join()
+        self.queues[-1].put(_STOP)
+
+    def _monitor(self):
+        while not self._finished.wait(self.report_interval):
+            self.log_stats()
+
+    def stats(self):
+        # Returns (name, workers, done, failed, utilisation, queue depth)
+        # for each stage, utilisation being busy time over worker time
+        elapsed = timeit.default_timer() - self._started
+        ret = []
+        for pos, stage in enumerate(self.stages):
+            utilisation = 0.0
+            if elapsed > 0:
+                utilisation = stage.busy.value / (elapsed * stage.workers)
+            try:
+                depth = self.queues[pos].qsize()
+            except NotImplementedError:
+                depth = -1
+            ret.append((stage.name, stage.workers, stage.done.value, stage.failed.value, utilisation, depth))
+        return ret
+
+    def log_stats(self):
+        for name, workers, done, failed, utilisation, depth in self.stats():
+            logging.info("Stage %s: %d workers, %d done, %d failed, %.0f%% utilised, %d queued",
+                name, workers, done, failed, 100 * utilisation, depth)
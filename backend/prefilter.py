@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+#
+# Cheap rejections which run before an article is extracted or parsed
+#
+
+import logging
+import re
+
+from collections import Counter
+
+import langid
+
+# nasa.gov pages seg-fault the parser
+DEFAULT_DENY_LIST = ["nasa.gov"]
+SUPPORTED_TYPES   = ["text/html"]
+LANGUAGES         = ["en"]
+
+# langid only sees this much of each page's text, taken from a window
+# this many times larger starting at <body>
+LANG_SAMPLE_BYTES = 16384
+LANG_WINDOW_FACTOR = 4
+
+BODY_RE   = re.compile(r"<body\b", re.I)
+SCRIPT_RE = re.compile(r"<(script|style)\b.*?(</\1\s*>|$)", re.I | re.S)
+COMMENT_RE = re.compile(r"<!--.*?(-->|$)", re.S)
+TAG_RE    = re.compile(r"<[^>]*(>|$)")
+SPACE_RE  = re.compile(r"\s+")
+
+# Log the counters every this many records
+REPORT_EVERY = 500
+
+def text_sample(content, sample_bytes=LANG_SAMPLE_BYTES):
+    # Roughly the first sample_bytes of a page's visible text, without
+    # parsing it: scripts, styles, comments and tags are cut out of a
+    # bounded window starting at <body>
+    match = BODY_RE.search(content)
+    start = 0
+    if match is not None:
+        start = match.start()
+    window = content[start:start + sample_bytes * LANG_WINDOW_FACTOR]
+    window = SCRIPT_RE.sub(" ", window)
+    window = COMMENT_RE.sub(" ", window)
+    window = TAG_RE.sub(" ", window)
+    return SPACE_RE.sub(" ", window).strip()[:sample_bytes]
+
+def preload():
+    # langid loads its model on first use
+    langid.classify("Models are loaded once.")
+
+class PreFilter(object):
+
+    # Returned for URLs on the deny list, which don't get an Article row
+    DENIED = "Denied"
+
+    def __init__(self, deny_list=DEFAULT_DENY_LIST, content_types=SUPPORTED_TYPES,
+        languages=LANGUAGES, sample_bytes=LANG_SAMPLE_BYTES):
+        self.deny_list = list(deny_list)
+        self.content_types = set(content_types)
+        self.languages = set(languages)
+        self.sample_bytes = sample_bytes
+        self.counters = Counter()
+
+    def check(self, url, content, content_type):
+        # Returns None if the record should be processed, otherwise the
+        # status to record against its Article (or DENIED)
+        ret = self._check(url, content, content_type)
+        if ret is None:
+            self.counters["passed"] += 1
+        self.counters["checked"] += 1
+        if self.counters["checked"] % REPORT_EVERY == 0:
+            self.log_counters()
+        return ret
+
+    def _check(self, url, content, content_type):
+        for denied in self.deny_list:
+            if denied in url:
+                self.counters["deny_list"] += 1
+                return self.DENIED
+
+        if content_type not in self.content_types:
+            logging.error("Unsupported content type: %s", str(content_type))
+            self.counters["content_type"] += 1
+            return "UnsupportedType"
+
+        lang, lang_certainty = langid.classify(text_sample(content, self.sample_bytes))
+        if lang not in self.languages:
+            logging.info("language: %s with certainty %.2f - skipping...", lang, lang_certainty)
+            self.counters["language"] += 1
+            return "LanguageError"
+
+        return None
+
+    def log_counters(self):
+        logging.info("PreFilter: %s", ", ".join("%s=%d" % (k, self.counters[k]) for k in sorted(self.counters)))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+#
+# Opt-in sampling profiler for crawl processing workers
+#
+# Every Nth call, or a random fraction of calls, runs under cProfile and
+# is dumped to <directory>/<pid>/<key>.prof alongside a .json file with
+# its wall time and memory use. Records slower than slow_seconds have
+# their raw page saved in the same directory, so they can be replayed
+# under a profiler later.
+#
+
+import cProfile
+import json
+import logging
+import os
+import random
+import resource
+import timeit
+
+PAGE_SIZE = resource.getpagesize()
+
+def current_rss():
+    # Resident set size in bytes, from /proc where there is one
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * PAGE_SIZE
+    except IOError:
+        return None
+
+def private_rss():
+    # Bytes only this process maps, i.e. not shared copy-on-write
+    try:
+        ret = 0
+        with open("/proc/self/smaps") as fp:
+            for line in fp:
+                if line.startswith("Private_"):
+                    ret += int(line.split()[1]) * 1024
+        return ret
+    except IOError:
+        return None
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class SamplingProfiler(object):
+
+    def __init__(self, directory, every=None, fraction=None, slow_seconds=None):
+        self.directory = directory
+        self.every = every
+        self.fraction = fraction
+        self.slow_seconds = slow_seconds
+        self.calls = 0
+
+    def _worker_dir(self):
+        # Decided on use rather than construction, since the profiler is
+        # built before the pool forks
+        ret = os.path.join(self.directory, str(os.getpid()))
+        if not os.path.exists(ret):
+            os.makedirs(ret)
+        return ret
+
+    def should_sample(self):
+        self.calls += 1
+        if self.every is not None and self.calls % self.every == 0:
+            return True
+        if self.fraction is not None and random.random() < self.fraction:
+            return True
+        return False
+
+    def run(self, key, func, *args):
+        # Returns func's result and how long it took
+        profile = None
+        if self.should_sample():
+            profile = cProfile.Profile()
+
+        rss_before = current_rss()
+        start = timeit.default_timer()
+        if profile is None:
+            ret = func(*args)
+        else:
+            ret = profile.runcall(func, *args)
+        elapsed = timeit.default_timer() - start
+
+        if profile is not None:
+            self._dump(key, profile, elapsed, rss_before)
+        return ret, elapsed
+
+    def is_slow(self, elapsed):
+        return self.slow_seconds is not None and elapsed >= self.slow_seconds
+
+    def _write_meta(self, path, key, elapsed, **extra):
+        meta = {"key": key, "pid": os.getpid(), "seconds": elapsed, "peak_rss": peak_rss()}
+        meta.update(extra)
+        with open(path, "w") as fp:
+            json.dump(meta, fp)
+
+    def _dump(self, key, profile, elapsed, rss_before):
+        try:
+            base = os.path.join(self._worker_dir(), str(key))
+            profile.dump_stats(base + ".prof")
+            self._write_meta(base + ".json", key, elapsed, rss_before=rss_before, rss_after=current_rss())
+        except (IOError, OSError) as ex:
+            logging.error("Can't write profile for %s: %s", key, ex)
+
+    def capture_slow(self, key, elapsed, url, content):
+        # Keeps a pathological page for replaying later
+        logging.warning("%s took %.2fs, capturing it", url, elapsed)
+        try:
+            base = os.path.join(self._worker_dir(), "slow-%s" % (key,))
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            with open(base + ".html", "wb") as fp:
+                fp.write(content)
+            self._write_meta(base + ".json", key, elapsed, url=url, bytes=len(content), rss=current_rss())
+        except (IOError, OSError) as ex:
+            logging.error("Can't capture slow record %s: %s", key, ex)
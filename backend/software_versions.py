@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+#
+# Per-process SoftwareVersion registry
+#
+# Each version string is resolved (or created) with a single upsert the
+# first time it's seen, so SoftwareInvolvementRecords can be written by
+# id without querying or merging SoftwareVersion objects per article.
+#
+
+import logging
+
+from upsert import upsert_id
+
+UPSERT_SQL = "INSERT INTO software (`software`) VALUES (:software) ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)"
+
+class SoftwareVersionRegistry(object):
+
+    def __init__(self, session):
+        # session should be its own, since new versions are committed
+        # straight away
+        self.session = session
+        self._ids = {}
+
+    def get_id(self, version):
+        version = version.strip()
+        _id = self._ids.get(version)
+        if _id is not None:
+            return _id
+
+        _id = upsert_id(self.session, UPSERT_SQL, {"software": version})
+
+        logging.info("SoftwareVersion %s has id %d", version, _id)
+        self._ids[version] = _id
+        return _id
+
+    def involvements(self, document_id, records):
+        # Converts (version, action) pairs into software_involvements rows
+        return [{"document_id": document_id, "software_id": self.get_id(version), "action": action}
+            for version, action in records]
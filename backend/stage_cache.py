@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+#
+# Content-addressed cache of stage results
+#
+# Extractor output, pydate's date dict and the classifier's output are
+# kept in a local SQLite file, keyed by stage and a hash of that stage's
+# input. Each entry is tagged with the version string of the software
+# which produced it, and only reused while that version is current.
+# Least recently used entries are evicted once the file's contents pass
+# max_bytes.
+#
+
+import cPickle
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+from collections import Counter
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Check the size every this many writes, and evict down to this much of it
+CHECK_EVERY = 200
+EVICT_TO = 0.9
+
+# Log the counters every this many lookups
+REPORT_EVERY = 1000
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS entries (
+    stage   TEXT NOT NULL,
+    digest  TEXT NOT NULL,
+    version TEXT NOT NULL,
+    value   BLOB NOT NULL,
+    size    INTEGER NOT NULL,
+    used    REAL NOT NULL,
+    PRIMARY KEY (stage, digest)
+)"""
+
+def digest(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+class StageCache(object):
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.counters = Counter()
+        self._con = None
+        self._pid = None
+        self._writes = 0
+
+    def _connection(self):
+        # Connections can't cross a fork, so each process opens its own
+        if self._con is None or self._pid != os.getpid():
+            self._con = sqlite3.connect(self.path, timeout=30)
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute(SCHEMA)
+            self._con.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            self._con.commit()
+            self._pid = os.getpid()
+        return self._con
+
+    def get(self, stage, key, version):
+        # Returns the cached value, or None on a miss or a stale version
+        self.counters["lookups"] += 1
+        if self.counters["lookups"] % REPORT_EVERY == 0:
+            self.log_counters()
+        if version is None:
+            self.counters["misses"] += 1
+            return None
+
+        try:
+            con = self._connection()
+            row = con.execute("SELECT version, value FROM entries WHERE stage = ? AND digest = ?", (stage, key)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            if row[0] != version:
+                self.counters["stale"] += 1
+                return None
+            con.execute("UPDATE entries SET used = ? WHERE stage = ? AND digest = ?", (time.time(), stage, key))
+            con.commit()
+            value = cPickle.loads(zlib.decompress(str(row[1])))
+        except (sqlite3.Error, cPickle.UnpicklingError, zlib.error) as ex:
+            logging.error("StageCache: can't read %s/%s: %s", stage, key, ex)
+            self.counters["errors"] += 1
+            return None
+
+        self.counters["hits"] += 1
+        return value
+
+    def put(self, stage, key, version, value):
+        if version is None:
+            return
+        try:
+            blob = zlib.compress(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+            con = self._connection()
+            con.execute("INSERT OR REPLACE INTO entries (stage, digest, version, value, size, used) VALUES (?, ?, ?, ?, ?, ?)",
+                (stage, key, version, sqlite3.Binary(blob), len(blob), time.time()))
+            con.commit()
+        except (sqlite3.Error, cPickle.PicklingError, TypeError) as ex:
+            logging.error("StageCache: can't write %s/%s: %s", stage, key, ex)
+            self.counters["errors"] += 1
+            return
+
+        self._writes += 1
+        if self._writes % CHECK_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        # Drops least recently used entries until under EVICT_TO of max_bytes
+        con = self._connection()
+        total, = con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        excess = total - int(self.max_bytes * EVICT_TO)
+        doomed = []
+        for stage, key, size in con.execute("SELECT stage, digest, size FROM entries ORDER BY used").fetchall():
+            if excess <= 0:
+                break
+            doomed.append((stage, key))
+            excess -= size
+        con.executemany("DELETE FROM entries WHERE stage = ? AND digest = ?", doomed)
+        con.commit()
+        self.counters["evicted"] += len(doomed)
+        logging.info("StageCache: evicted %d entries from %s", len(doomed), self.path)
+
+    def log_counters(self):
+        logging.info("StageCache: %d lookups, %d hits, %d misses, %d stale, %d evicted, %d errors",
+            self.counters["lookups"], self.counters["hits"], self.counters["misses"],
+            self.counters["stale"], self.counters["evicted"], self.counters["errors"])
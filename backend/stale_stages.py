@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+#
+# Incremental reprocessing of stale stages
+#
+# Each Document has a software_involvements row per component, naming the
+# version which produced that part of it. After pydate or pysen is
+# upgraded, only the documents whose "Dated" or "Classified" row names an
+# older version need that stage run again, and only the rows the stage
+# wrote (dates, or the Document's scores with its sentences, phrases and
+# keyword incidences) are replaced, a batch of documents at a time.
+#
+# Both stages start from the raw page, which is only kept once processed
+# if crawl_process.py ran with --keep-content. Documents whose page has
+# gone are skipped and counted.
+#
+
+import logging
+
+from collections import Counter
+
+from sqlalchemy import or_
+
+import pydate
+import pysen
+
+from db import Document, Sentence, Phrase, Keyword
+from db import KeywordIncidence, KeywordAdjacency, SoftwareInvolvementRecord
+from db import CertainDate, AmbiguousDate
+from document_model import parse_document, truncate, over_node_budget
+from nlp import split_sentences
+
+BATCH_SIZE = 100
+
+STALE_SQL = """SELECT si.document_id, a.domain_id, r.content
+    FROM software_involvements si
+    JOIN documents d ON d.id = si.document_id
+    JOIN articles a ON a.id = d.article_id
+    LEFT JOIN raw_article_conversions_2 c ON c.inserted_id = a.id
+    LEFT JOIN raw_articles_2 r ON r.id = c.raw_article_id
+    WHERE si.action = :action AND si.software_id != :current AND si.document_id > :after
+    ORDER BY si.document_id
+    LIMIT :limit"""
+
+class StaleStageReprocessor(object):
+
+    VERSIONS = {
+        "Dated": pydate.__VERSION__,
+        "Classified": pysen.__VERSION__,
+    }
+
+    def __init__(self, processor, batch_size=BATCH_SIZE):
+        # processor is a CrawlProcessor, whose session, extractor, stage
+        # cache and boilerplate filter are reused
+        self.cp = processor
+        self.session = processor._session
+        self.batch_size = batch_size
+        self.counters = Counter()
+
+    def run(self, action):
+        # Brings every document's record for action up to date, returns
+        # how many were
+        if action not in self.VERSIONS:
+            raise ValueError(("Only these stages can be run on their own", sorted(self.VERSIONS), action))
+        current = self.cp.versions.get_id(self.VERSIONS[action])
+        logging.info("Reprocessing documents not %s by %s", action, self.VERSIONS[action])
+
+        after = 0
+        while True:
+            rows = self.session.execute(STALE_SQL, {"action": action, "current": current,
+                "after": after, "limit": self.batch_size}).fetchall()
+            if len(rows) == 0:
+                break
+            after = rows[-1][0]
+
+            if action == "Dated":
+                done = self.redate(rows)
+            else:
+                done = self.reclassify(rows)
+
+            if len(done) > 0:
+                self.session.query(SoftwareInvolvementRecord).filter(SoftwareInvolvementRecord.action == action,
+                    SoftwareInvolvementRecord.document_id.in_(done)).update(
+                    {"software_id": current}, synchronize_session=False)
+            self.session.commit()
+            self.counters["updated"] += len(done)
+            self.log_counters()
+
+        return self.counters["updated"]
+
+    def _page(self, document_id, domain_id, content):
+        # Returns (page, parsed page, boilerplate-filtered body) as
+        # parse_stage left them, or None if the page doesn't get that far
+        if content is None:
+            self.counters["no_source"] += 1
+            return None
+
+        content = truncate(content, self.cp.max_page_bytes)[0]
+        if over_node_budget(content, self.cp.max_dom_nodes):
+            self.counters["no_content"] += 1
+            return None
+        job = None
+        if not self.cp.extractor.needs_tree:
+            job = self.cp.submit_extraction(content)
+        html = parse_document(content, self.cp.parse_mode, self.cp.max_dom_nodes, precheck=False)
+        if html.too_large or not html.has_body:
+            self.counters["no_content"] += 1
+            return None
+        if job is None:
+            job = self.cp.submit_extraction(content, html.tree)
+        job.join()
+        self.cp._finish_extraction(job, content)
+        if job.result is None:
+            self.counters["no_content"] += 1
+            return None
+
+        body = job.result.encode('ascii', 'ignore')
+        sentences = self.cp.bpf.filter(domain_id, split_sentences(body), count=False)
+        if len(sentences) == 0:
+            self.counters["no_content"] += 1
+            return None
+        return content, html, " ".join(sentences)
+
+    def _documents(self, ids):
+        return dict((doc.id, doc) for doc in self.session.query(Document).filter(Document.id.in_(ids)))
+
+    def redate(self, rows):
+        # Replaces the dates of each document, returns the ids done
+        found = {}
+        for document_id, domain_id, content in rows:
+            page = self._page(document_id, domain_id, content)
+            if page is None:
+                continue
+            content, html, body = page
+            found[document_id] = (self.cp._cached("dates", content, self.cp._dates_version, lambda: pydate.get_dates(html.soup)), body)
+
+        done = found.keys()
+        if len(done) == 0:
+            return done
+
+        for table in [CertainDate, AmbiguousDate]:
+            self.session.query(table).filter(table.doc_id.in_(done)).delete(synchronize_session=False)
+        for document_id, doc in self._documents(done).iteritems():
+            date_dict, body = found[document_id]
+            self.cp._add_dates(doc, date_dict, body)
+        self.session.flush()
+        return done
+
+    def _keyword_ids(self, ids):
+        # {document id: {word: keyword id}} for the keywords stored against
+        # each document's phrases or in its adjacency list
+        ret = dict((document_id, {}) for document_id in ids)
+        incidences = self.session.query(Sentence.document, Keyword.word, Keyword.id)\
+            .join(Phrase, Phrase.sentence == Sentence.id)\
+            .join(KeywordIncidence, KeywordIncidence.phrase_id == Phrase.id)\
+            .join(Keyword, Keyword.id == KeywordIncidence.keyword_id)\
+            .filter(Sentence.document.in_(ids)).distinct()
+        adjacencies = self.session.query(KeywordAdjacency.doc_id, Keyword.word, Keyword.id)\
+            .join(Keyword, or_(Keyword.id == KeywordAdjacency.key1_id, Keyword.id == KeywordAdjacency.key2_id))\
+            .filter(KeywordAdjacency.doc_id.in_(ids)).distinct()
+        for query in [incidences, adjacencies]:
+            for document_id, word, keyword_id in query:
+                ret[document_id][word] = keyword_id
+        return ret
+
+    def reclassify(self, rows):
+        # Replaces the classification of each document, returns the ids done
+        found = {}
+        for document_id, domain_id, content in rows:
+            page = self._page(document_id, domain_id, content)
+            if page is None:
+                continue
+            content, html, body = page
+            try:
+                features, trace = self.cp._cached("classify", body, pysen.__VERSION__, self.cp._classify, body)
+            except Exception as ex:
+                logging.exception("Document %d: can't classify: %s", document_id, ex)
+                self.counters["errors"] += 1
+                continue
+            text_nodes = [(unicode(node), tag) for node, tag in html.text_nodes]
+            found[document_id] = (features, trace, text_nodes)
+
+        if len(found) == 0:
+            return []
+
+        documents = self._documents(found.keys())
+        done = []
+        for document_id, doc in documents.iteritems():
+            label, length, classified, pos_sentences, neg_sentences, pos_phrases, neg_phrases = found[document_id][0]
+            try:
+                doc.set_classification(label, length, pos_sentences, neg_sentences, pos_phrases, neg_phrases)
+            except ValueError as ex:
+                logging.error("Document %d: %s", document_id, ex)
+                self.session.expire(doc)
+                self.counters["errors"] += 1
+                continue
+            done.append(document_id)
+        if len(done) == 0:
+            return done
+
+        # Keywords are matched against the new phrases, so fetch them
+        # before the old ones go
+        keyword_ids = self._keyword_ids(done)
+        sentence_ids = [row[0] for row in self.session.query(Sentence.id).filter(Sentence.document.in_(done))]
+        if len(sentence_ids) > 0:
+            phrase_ids = [row[0] for row in self.session.query(Phrase.id).filter(Phrase.sentence.in_(sentence_ids))]
+            if len(phrase_ids) > 0:
+                self.session.query(KeywordIncidence).filter(KeywordIncidence.phrase_id.in_(phrase_ids)).delete(synchronize_session=False)
+                self.session.query(Phrase).filter(Phrase.id.in_(phrase_ids)).delete(synchronize_session=False)
+            self.session.query(Sentence).filter(Sentence.id.in_(sentence_ids)).delete(synchronize_session=False)
+
+        keyword_phrases = []
+        for document_id in done:
+            features, trace, text_nodes = found[document_id]
+            extracted_phrases = self.cp._add_sentences(documents[document_id], trace, text_nodes)
+            keyword_phrases.extend(self.cp._keyword_phrases(keyword_ids[document_id], extracted_phrases))
+        self.session.flush()
+
+        incidences = set((keyword_id, p_obj.id) for keyword_id, p_obj in keyword_phrases)
+        if len(incidences) > 0:
+            self.session.execute(KeywordIncidence.__table__.insert(),
+                [{"keyword_id": keyword_id, "phrase_id": phrase_id} for keyword_id, phrase_id in incidences])
+        return done
+
+    def log_counters(self):
+        logging.info("Reprocessed %d documents, %d without a raw page, %d without content, %d errors",
+            self.counters["updated"], self.counters["no_source"], self.counters["no_content"], self.counters["errors"])
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+#
+# Text node index: maps sentences back to the tag which encloses them
+#
+
+import bisect
+
+# Joins the text nodes together. Nothing extracted from a document should
+# contain it, so a match can never span two nodes.
+SEPARATOR = u"\x00"
+
+class TextNodeIndex(object):
+
+    def __init__(self, nodes):
+        # nodes: iterable of (text, parent tag name) pairs in document order
+        self._starts = []
+        self._tags   = []
+        chunks = []
+        offset = 0
+        for text, tag in nodes:
+            text = text.strip()
+            self._starts.append(offset)
+            self._tags.append(tag)
+            chunks.append(text)
+            offset += len(text) + len(SEPARATOR)
+        self._text = SEPARATOR.join(chunks)
+
+    def __len__(self):
+        return len(self._tags)
+
+    def get_tag(self, text, default=None):
+        # Returns the tag of the first node which contains text, which is
+        # the same answer as testing each node in turn
+        if SEPARATOR in text or len(self._tags) == 0:
+            return default
+        pos = self._text.find(text)
+        if pos == -1:
+            return default
+        return self._tags[bisect.bisect_right(self._starts, pos) - 1]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+#
+# Per-stage timing breakdown for each processed article
+#
+# Stages add their wall-clock time to a plain dict carried with the
+# article (so it survives being pickled between stage processes), and
+# once the Article is committed the breakdown is appended to a
+# JSON-lines file keyed by Article id.
+#
+
+import json
+import logging
+import os
+import time
+import timeit
+
+from contextlib import contextmanager
+
+# In the order they run, for reports
+STAGES = ["prefilter", "domain", "parse", "dates", "extract", "dedup", "boilerplate",
+    "pos_tag", "terms", "classify", "keywords", "links", "commit"]
+
+@contextmanager
+def timed(timings, stage):
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + timeit.default_timer() - start
+
+def percentile(values, pct):
+    values = sorted(values)
+    pos = int(round((len(values) - 1) * pct / 100.0))
+    return values[pos]
+
+class TimingLog(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        # records is a list of (article id, status, {stage: seconds}). The
+        # file is reopened each time, so forked workers can share it, and
+        # the batch goes out in one O_APPEND write so workers' lines
+        # don't interleave.
+        now = time.time()
+        lines = []
+        for article_id, status, stages in records:
+            stages = dict((k, round(v, 6)) for k, v in stages.iteritems())
+            lines.append(json.dumps({"id": article_id, "status": status, "at": round(now, 3), "stages": stages}) + "\n")
+        if len(lines) == 0:
+            return
+        data = "".join(lines)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                while len(data) > 0:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+        except OSError as ex:
+            logging.error("Can't write timings to %s: %s", self.path, ex)
+
+    def read(self, since=None):
+        # Yields each record at or after the since timestamp
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partly written by a worker which died
+                    continue
+                if since is not None and record["at"] < since:
+                    continue
+                yield record
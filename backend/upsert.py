@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+#
+# Id-returning upserts for the lookup tables (domains, software)
+#
+# The SQL should end "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)":
+# LAST_INSERT_ID(id) makes lastrowid the existing row's id on a
+# duplicate, so one statement returns the id whether or not the row
+# already existed.
+#
+
+def upsert_id(session, sql, params):
+    # Runs and commits sql on session, which should be its own since new
+    # rows are committed straight away. Returns the row's id.
+    try:
+        _id = session.execute(sql, params).lastrowid
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    if not _id:
+        raise ValueError(("Upsert returned no id", params))
+    return _id
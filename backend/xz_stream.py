@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+#
+# Streaming xz decompression
+#
+# Compressed chunks are decompressed as they arrive, straight into the
+# output file, so a download never needs a compressed copy on disk. Uses
+# lzma where it's installed (backports.lzma on Python 2) and pipes
+# through an xz process otherwise.
+#
+
+import os
+import subprocess
+
+try:
+    import lzma
+except ImportError:
+    try:
+        # Python 2
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+class XZStreamWriter(object):
+
+    def __init__(self, fname, use_lzma=True):
+        self.fname = fname
+        self.compressed = 0
+        self._out = open(fname, 'wb')
+        self._lzma = None
+        self._proc = None
+        if use_lzma and lzma is not None:
+            self._lzma = lzma.LZMADecompressor()
+        else:
+            self._proc = subprocess.Popen(["xz", "-dc"], stdin=subprocess.PIPE, stdout=self._out)
+
+    def write(self, data):
+        self.compressed += len(data)
+        if self._proc is not None:
+            self._proc.stdin.write(data)
+            return
+
+        # xz files can hold several streams back to back, separated by
+        # NUL padding, and a stream can end exactly at the end of a chunk
+        while len(data) > 0:
+            if self._lzma.eof:
+                data = data.lstrip(b"\0")
+                if len(data) == 0:
+                    break
+                self._lzma = lzma.LZMADecompressor()
+            self._out.write(self._lzma.decompress(data))
+            data = self._lzma.unused_data if self._lzma.eof else b""
+
+    def close(self):
+        # Returns the decompressed size
+        if self._proc is not None:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                raise subprocess.CalledProcessError(self._proc.returncode, "xz -dc")
+        elif not self._lzma.eof:
+            raise EOFError("xz data ended before the end of the stream")
+        self._out.close()
+        return os.path.getsize(self.fname)
+
+    def abort(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._out.close()
+        os.remove(self.fname)
+
+def decompress_chunks(chunks, fname, use_lzma=True):
+    # Decompresses an iterable of xz chunks into fname, which is removed if
+    # anything goes wrong. Returns (compressed, decompressed) bytes.
+    writer = XZStreamWriter(fname, use_lzma)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        size = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer.compressed, size
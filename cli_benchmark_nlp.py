@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+#
+# Compares POS tagging throughput: the old per-sentence nltk.pos_tag
+# loop, one call per document, and one call per batch of K documents.
+# Documents come from plain text files given on the command line, or
+# with --raw N from the text of the first N unprocessed raw articles.
+#
+
+import logging
+import sys
+import timeit
+
+import nltk
+
+from backend.nlp import split_sentences, tag_sentences, tag_documents
+
+def load_raw_articles(limit):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm.session import Session
+    from backend.db import RawArticle
+    from backend.document_model import parse_document
+    import core
+
+    engine = create_engine(core.get_database_engine_string(), encoding='utf-8')
+    session = Session(bind=engine, autocommit = False)
+    it = session.query(RawArticle).filter(RawArticle.content != None).limit(limit)
+    ret = []
+    for article in it:
+        if article.content_type != 'text/html':
+            continue
+        html = parse_document(article.content, "lxml")
+        ret.append(u" ".join(text for text, tag in html.text_nodes if tag not in ("script", "style")))
+    return ret
+
+def per_sentence(documents, batch_size):
+    for sentences in documents:
+        for sentence in sentences:
+            nltk.pos_tag(nltk.word_tokenize(sentence))
+
+def per_document(documents, batch_size):
+    for sentences in documents:
+        tag_sentences(sentences)
+
+def batched(documents, batch_size):
+    for pos in range(0, len(documents), batch_size):
+        tag_documents(documents[pos:pos+batch_size])
+
+MODES = [("sentence", per_sentence), ("document", per_document), ("batch", batched)]
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+
+    texts = []
+    batch_size = 16
+    skip = False
+    for pos, arg in enumerate(sys.argv[1:]):
+        if skip:
+            skip = False
+            continue
+        if arg == "--raw":
+            texts.extend(load_raw_articles(int(sys.argv[pos+2])))
+            skip = True
+        elif arg == "--batch":
+            batch_size = int(sys.argv[pos+2])
+            skip = True
+        else:
+            with open(arg) as fp:
+                texts.append(fp.read().decode('utf-8', 'ignore'))
+
+    if len(texts) == 0:
+        print >> sys.stderr, "usage: python cli_benchmark_nlp.py [--batch K] [--raw N] [file.txt ...]"
+        sys.exit(1)
+
+    documents = [split_sentences(text) for text in texts]
+    sentences = sum(len(d) for d in documents)
+
+    # Load the models before timing anything
+    tag_documents(documents[:1])
+
+    print "%d documents, %d sentences, batches of %d" % (len(documents), sentences, batch_size)
+    print "%-9s %10s %12s %14s %8s" % ("mode", "seconds", "docs/sec", "sentences/sec", "speedup")
+    baseline = None
+    for name, func in MODES:
+        start = timeit.default_timer()
+        func(documents, batch_size)
+        elapsed = timeit.default_timer() - start
+        if baseline is None:
+            baseline = elapsed
+        print "%-9s %10.2f %12.1f %14.1f %7.2fx" % (name, elapsed, len(documents) / elapsed,
+            sentences / elapsed, baseline / elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+#
+# Compares parse+walk time per page for the BeautifulSoup and lxml
+# document models, and again with the BeautifulSoup tree pydate needs,
+# which lxml mode builds with a second parse unless dates are cached.
+# Pages come from HTML files given on the command line, or with --raw N
+# from the first N unprocessed raw articles.
+#
+
+import logging
+import sys
+import timeit
+
+from backend.document_model import parse_document
+from backend.timings import percentile
+
+MODES = ["soup", "lxml"]
+
+# (name, whether the soup tree for pydate is built too)
+RUNS = [("parse+walk", False), ("+dates tree", True)]
+
+def load_raw_articles(limit):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm.session import Session
+    from backend.db import RawArticle
+    import core
+
+    engine = create_engine(core.get_database_engine_string(), encoding='utf-8')
+    session = Session(bind=engine, autocommit = False)
+    it = session.query(RawArticle).filter(RawArticle.content != None).limit(limit)
+    return [a.content for a in it if a.content_type == 'text/html']
+
+def benchmark(pages, repeat=3):
+    # Returns {(mode, run name): [best seconds per page]}
+    timings = dict(((mode, name), []) for mode in MODES for name, dates in RUNS)
+    for content in pages:
+        for mode in MODES:
+            for name, dates in RUNS:
+                best = None
+                for i in range(repeat):
+                    start = timeit.default_timer()
+                    html = parse_document(content, mode)
+                    if dates:
+                        html.soup
+                    elapsed = timeit.default_timer() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                timings[(mode, name)].append(best)
+    return timings
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+
+    pages = []
+    files = []
+    skip = False
+    for pos, arg in enumerate(sys.argv[1:]):
+        if skip:
+            skip = False
+            continue
+        if arg == "--raw":
+            pages.extend(load_raw_articles(int(sys.argv[pos+2])))
+            skip = True
+        else:
+            files.append(arg)
+
+    for fname in files:
+        with open(fname, 'rb') as fp:
+            pages.append(fp.read())
+
+    if len(pages) == 0:
+        print >> sys.stderr, "usage: python cli_benchmark_parse.py [--raw N] [file.html ...]"
+        sys.exit(1)
+
+    timings = benchmark(pages)
+    total_bytes = sum(len(p) for p in pages)
+    print "%d pages, %.1f KiB mean size" % (len(pages), total_bytes / 1024.0 / len(pages))
+    print "%-6s %-12s %10s %10s %10s %10s" % ("mode", "run", "mean ms", "p50 ms", "p95 ms", "max ms")
+    for name, dates in RUNS:
+        for mode in MODES:
+            t = timings[(mode, name)]
+            print "%-6s %-12s %10.2f %10.2f %10.2f %10.2f" % (mode, name, 1000 * sum(t) / len(t),
+                1000 * percentile(t, 50), 1000 * percentile(t, 95), 1000 * max(t))
+
+if __name__ == "__main__":
+    main()
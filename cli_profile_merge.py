@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+#
+# Merges the cProfile dumps every crawl_process.py worker wrote under the
+# profile directory, and lists the slow pages they captured:
+# python cli_profile_merge.py [--sort cumulative] [--limit 40] [--out merged.prof] [dir]
+#
+
+import json
+import os
+import pstats
+import sys
+
+import core
+
+def find_files(directory, suffix, prefix=""):
+    ret = []
+    for root, dirs, files in os.walk(directory):
+        for fname in files:
+            if fname.endswith(suffix) and fname.startswith(prefix):
+                ret.append(os.path.join(root, fname))
+    return sorted(ret)
+
+def load_meta(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+def main():
+    directory = core.get_profile_dir()
+    sort = "cumulative"
+    limit = 40
+    out = None
+    skip = False
+    for pos, arg in enumerate(sys.argv[1:]):
+        if skip:
+            skip = False
+            continue
+        if arg == "--sort":
+            sort = sys.argv[pos+2]
+            skip = True
+        elif arg == "--limit":
+            limit = int(sys.argv[pos+2])
+            skip = True
+        elif arg == "--out":
+            out = sys.argv[pos+2]
+            skip = True
+        else:
+            directory = arg
+
+    dumps = find_files(directory, ".prof")
+    if len(dumps) == 0:
+        print >> sys.stderr, "No profiles under %s" % (directory,)
+        sys.exit(1)
+
+    stats = pstats.Stats(dumps[0])
+    for path in dumps[1:]:
+        stats.add(path)
+
+    workers = set(os.path.basename(os.path.dirname(path)) for path in dumps)
+    samples = [load_meta(path[:-len(".prof")] + ".json") for path in dumps
+        if os.path.exists(path[:-len(".prof")] + ".json")]
+    print "%d samples from %d workers" % (len(dumps), len(workers))
+    if len(samples) > 0:
+        print "mean %.3fs per sampled record, peak RSS %.1f MiB" % (
+            sum(s["seconds"] for s in samples) / len(samples),
+            max(s["peak_rss"] for s in samples) / 1048576.0)
+
+    if out is not None:
+        stats.dump_stats(out)
+        print "Merged profile written to %s" % (out,)
+    stats.sort_stats(sort).print_stats(limit)
+
+    slow = [load_meta(path) for path in find_files(directory, ".json", "slow-")]
+    if len(slow) > 0:
+        print "Slow records captured:"
+        for meta in sorted(slow, key=lambda m: m["seconds"], reverse=True):
+            print "%8.2fs %8d bytes  %s  (%s/slow-%s.html)" % (meta["seconds"], meta["bytes"], meta["url"],
+                meta["pid"], meta["key"])
+
+if __name__ == "__main__":
+    main()
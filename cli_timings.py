@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+#
+# Summarises the per-stage timings crawl_process.py writes for each
+# article: python cli_timings.py [--hours N | --since "YYYY-MM-DD HH:MM"] [timings.jsonl]
+#
+
+import datetime
+import sys
+import time
+
+import core
+
+from backend.timings import TimingLog, STAGES, percentile
+
+def summarise(records):
+    # Returns {stage: [seconds, ...]}, plus the per-article total
+    ret = {"total": []}
+    for record in records:
+        stages = record["stages"]
+        for stage, seconds in stages.iteritems():
+            ret.setdefault(stage, []).append(seconds)
+        ret["total"].append(sum(stages.values()))
+    return ret
+
+def main():
+    path = core.get_timing_log_path()
+    since = None
+    skip = False
+    for pos, arg in enumerate(sys.argv[1:]):
+        if skip:
+            skip = False
+            continue
+        if arg == "--hours":
+            since = time.time() - 3600 * float(sys.argv[pos+2])
+            skip = True
+        elif arg == "--since":
+            when = datetime.datetime.strptime(sys.argv[pos+2], "%Y-%m-%d %H:%M")
+            since = time.mktime(when.timetuple())
+            skip = True
+        else:
+            path = arg
+
+    if path is None:
+        print >> sys.stderr, "No timing log: set SENT_TIMING_LOG or give its path"
+        sys.exit(1)
+
+    timings = summarise(TimingLog(path).read(since))
+    if len(timings["total"]) == 0:
+        print >> sys.stderr, "No timings in %s for that window" % (path,)
+        sys.exit(1)
+
+    order = STAGES + sorted(set(timings) - set(STAGES) - set(["total"])) + ["total"]
+    print "%d articles" % (len(timings["total"]),)
+    print "%-12s %8s %10s %10s %10s %10s" % ("stage", "n", "mean ms", "p50 ms", "p95 ms", "p99 ms")
+    for stage in order:
+        t = timings.get(stage)
+        if not t:
+            continue
+        print "%-12s %8d %10.2f %10.2f %10.2f %10.2f" % (stage, len(t), 1000 * sum(t) / len(t),
+            1000 * percentile(t, 50), 1000 * percentile(t, 95), 1000 * percentile(t, 99))
+
+if __name__ == "__main__":
+    main()
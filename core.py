@@ -55,4 +55,55 @@ def get_redis_host():
 	if "SENT_REDIS_HOST" not in os.environ:
 		return 'localhost'
 
-	return os.environ['SENT_REDIS_HOST']
\ No newline at end of file
+	return os.environ['SENT_REDIS_HOST']
+
+def get_extractor_name():
+	if "SENT_EXTRACTOR" not in os.environ:
+		return 'boilerpipe'
+
+	return os.environ['SENT_EXTRACTOR']
+
+def get_parse_mode():
+	if "SENT_PARSE_MODE" not in os.environ:
+		return 'soup'
+
+	return os.environ['SENT_PARSE_MODE']
+
+def get_timing_log_path():
+	if "SENT_TIMING_LOG" not in os.environ:
+		return None
+
+	return os.environ['SENT_TIMING_LOG']
+
+def get_profile_dir():
+	if "SENT_PROFILE_DIR" not in os.environ:
+		return '/var/log/sentropy/profiles'
+
+	return os.environ['SENT_PROFILE_DIR']
+
+def get_max_page_bytes():
+	if "SENT_MAX_PAGE_BYTES" not in os.environ:
+		# Imported here, since the backend package pulls in everything
+		from backend.document_model import MAX_PAGE_BYTES
+		return MAX_PAGE_BYTES
+
+	return int(os.environ['SENT_MAX_PAGE_BYTES'])
+
+def get_max_dom_nodes():
+	if "SENT_MAX_DOM_NODES" not in os.environ:
+		from backend.document_model import MAX_DOM_NODES
+		return MAX_DOM_NODES
+
+	return int(os.environ['SENT_MAX_DOM_NODES'])
+
+def get_stage_cache_path():
+	if "SENT_STAGE_CACHE" not in os.environ:
+		return None
+
+	return os.environ['SENT_STAGE_CACHE']
+
+def get_stage_cache_bytes():
+	if "SENT_STAGE_CACHE_MB" not in os.environ:
+		return 1024 * 1024 * 1024
+
+	return int(os.environ['SENT_STAGE_CACHE_MB']) * 1024 * 1024
@@ -3,9 +3,12 @@
 # Crawl process helper
 
 import multiprocessing
+import gc
 import logging
 import os
 import sys
+import threading
+import timeit
 
 import core
 import itertools
@@ -18,66 +21,363 @@ from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.exc import *
 
 from backend import CrawlQueue, CrawlFileController, CrawlProcessor, ProcessQueue
+from backend import get_extractor
+from backend.pipeline import Stage, StagedPipeline
+from backend.concurrent_io import ConcurrentIOEngine, IO_THREADS, MAX_IN_FLIGHT
+from backend.extractors import ExtractionResult, PreExtracted, EXTRACTORS
+from backend.document_model import over_node_budget
+from backend.timings import TimingLog
+from backend.stage_cache import StageCache
+from backend.profiling import SamplingProfiler, current_rss, private_rss
+from backend.crawl_processor import preload_models
 from backend.db import SoftwareVersionsController, SoftwareVersion, RawArticle
 from backend.db import RawArticleResult, RawArticleResultLink
 
-def worker_init():
-    global cp 
-    global engine 
-    global session
+# Each worker process, or --concurrent-io thread, has its own
+# CrawlProcessor and session
+worker = threading.local()
 
+# Set by main() before the pool forks, when profiling is asked for
+profiler = None
+
+# Set by main() before the pool forks, with --keep-content
+keep_content = False
+
+# CrawlProcessor keyword arguments from preload_models, shared by every
+# worker forked after main() loads them
+models = {}
+
+# The --concurrent-io I/O threads' shared extractor, and so one BoilerPipe
+# connection pool, made by the first thread to start
+io_extractor = None
+io_extractor_lock = threading.Lock()
+
+def get_stage_cache():
+    path = core.get_stage_cache_path()
+    if path is None:
+        return None
+    return StageCache(path, core.get_stage_cache_bytes())
+
+def get_timing_log():
+    path = core.get_timing_log_path()
+    if path is None:
+        return None
+    return TimingLog(path)
+
+def init_processor(extractor, timing_log=None):
+    # Sets up this worker's CrawlProcessor, returns its engine
     engine = core.get_database_engine_string()
     logging.info("Using connection string '%s'" % (engine,))
     engine = create_engine(engine, encoding='utf-8', isolation_level="READ COMMITTED")
-    cp = CrawlProcessor(engine, core.get_redis_host())
-    session = Session(bind=engine, autocommit = False)
+    worker.cp = CrawlProcessor(engine, core.get_redis_host(), extractor=extractor,
+        parse_mode=core.get_parse_mode(), timing_log=timing_log,
+        max_page_bytes=core.get_max_page_bytes(), max_dom_nodes=core.get_max_dom_nodes(),
+        stage_cache=get_stage_cache(), **models)
+    return engine
+
+def worker_init(extractor=None):
+    start = timeit.default_timer()
+    if extractor is None:
+        extractor = get_extractor(core.get_extractor_name())
+
+    engine = init_processor(extractor, get_timing_log())
+    worker.session = Session(bind=engine, autocommit = False)
+    worker_ready(start)
+
+def io_worker_init():
+    # Run on each --concurrent-io I/O thread. The extractor's made here,
+    # after the worker processes have forked, so none of them inherits
+    # its client's threads or session.
+    global io_extractor
+    with io_extractor_lock:
+        if io_extractor is None:
+            io_extractor = get_extractor(core.get_extractor_name())
+    worker_init(io_extractor)
+
+def cpu_worker_init():
+    # --concurrent-io's worker processes only parse and analyse: pages
+    # arrive already extracted, unless the extractor needs our parse
+    # tree, and the I/O threads commit them, so there's no session or
+    # timing log either
+    start = timeit.default_timer()
+    name = core.get_extractor_name()
+    extractor = PreExtracted()
+    if EXTRACTORS[name].needs_tree:
+        extractor = get_extractor(name)
+    init_processor(extractor)
+    worker_ready(start)
+
+def worker_ready(start):
+    if len(models) == 0:
+        # Load the classifier now, so it's counted in the startup cost
+        worker.cp.cls
+    logging.info("Worker %d ready in %.2fs, RSS %.1f MiB, private %.1f MiB", os.getpid(),
+        timeit.default_timer() - start, (current_rss() or 0) / 1048576.0, (private_rss() or 0) / 1048576.0)
 
 
 def has_article_been_processed(article_id):
-    it = session.query(RawArticleResult).get(article_id)
+    it = worker.session.query(RawArticleResult).get(article_id)
     if it is None:
         return False 
     return True 
 
-def worker_func(article_id):
-
-    status = None 
-    record = None 
-    result_link = None 
+def load_raw_article(article_id):
+    # Returns the RawArticle if it still needs processing, otherwise None
 
     if has_article_been_processed(article_id):
-        return article_id 
+        return None
 
-    article = session.query(RawArticle).get(article_id)
+    article = worker.session.query(RawArticle).get(article_id)
     if article is None:
         logging.error("Article doesn't exist: shouldn't be possible. %d", article_id)
-        return article_id 
+        return None
 
     if article.headers is None or article.content is None:
         logging.error("Article %d has NULL headers and/or content. This is possible, but shouldn't happen often", article_id)
-        return article_id
+        return None
+
+    return article
 
-    status = cp.process_record((article.crawl_id, (article.headers, article.content, article.url, \
-        article.date_crawled, article.content_type)))
+def get_item(article):
+    return (article.crawl_id, (article.headers, article.content, article.url, \
+        article.date_crawled, article.content_type))
 
+def record_result(article, status):
     if status is None:
-        record = RawArticleResult(article_id, "Error")
+        record = RawArticleResult(article.id, "Error")
     else:
-        record = RawArticleResult(article_id, "Processed")
-        result_link = RawArticleResultLink(article_id, status)
-        session.add(result_link)
-        article.headers = None
-        article.content = None 
+        record = RawArticleResult(article.id, "Processed")
+        result_link = RawArticleResultLink(article.id, status)
+        worker.session.add(result_link)
+        if not keep_content:
+            article.headers = None
+            article.content = None 
+
+    worker.session.add(record)
+
+def record_failure(article_id):
+    # Records an Error for an article which raised part way through, so
+    # it's marked completed instead of coming back off the queue
+    worker.session.rollback()
+    worker.cp._session.rollback()
+    article = worker.session.query(RawArticle).get(article_id)
+    if article is not None:
+        record_result(article, None)
+        worker.session.commit()
+    return article_id
+
+def worker_func(article_id):
+
+    article = load_raw_article(article_id)
+    if article is None:
+        return article_id
+
+    item = get_item(article)
+    if profiler is None:
+        status = worker.cp.process_record(item)
+    else:
+        status, elapsed = profiler.run(article_id, worker.cp.process_record, item)
+        if profiler.is_slow(elapsed):
+            profiler.capture_slow(article_id, elapsed, article.url, article.content)
+
+    record_result(article, status)
+    worker.session.commit()
+
+    return article_id
+
+def worker_func_batch(article_ids):
+
+    pending = []
+    for article_id in article_ids:
+        article = load_raw_article(article_id)
+        if article is not None:
+            pending.append(article)
 
-    session.add(record)
-    session.commit()
+    statuses = worker.cp.process_batch([get_item(article) for article in pending])
+
+    for article, status in zip(pending, statuses):
+        record_result(article, status)
+
+    worker.session.commit()
+
+    return article_ids
+
+#
+# Stages for --pipeline. Items travel as (article_id, payload): a payload
+# of None means there's nothing to do, False that the article failed
+# _check_processed or raised in an earlier stage, otherwise it's the
+# CrawlProcessor's ArticleState.
+#
+
+def stage_fetch(article_id):
+    article = load_raw_article(article_id)
+    if article is None:
+        return (article_id, None)
+    return (article_id, get_item(article))
+
+def stage_failed(payload):
+    # Passes an article a stage raised on along to be recorded
+    if isinstance(payload, tuple):
+        return (payload[0], False)
+    return (payload, False)
+
+def stage_persist_failed(payload):
+    return record_failure(payload[0])
+
+def stage_extract(payload):
+    article_id, item = payload
+    if item is None or item is False:
+        return payload
+    if not worker.cp._check_processed(item):
+        return (article_id, False)
+    return (article_id, worker.cp.extract_stage(item))
+
+def stage_analyse(payload):
+    article_id, state = payload
+    if state:
+        state = worker.cp.analyse_stage(state)
+    return (article_id, state)
+
+def stage_persist(payload):
+    article_id, state = payload
+    if state is None:
+        return article_id
+
+    status = None
+    if state is not False:
+        status = worker.cp.process_state(state)
+
+    record_result(worker.session.query(RawArticle).get(article_id), status)
+    worker.session.commit()
 
     return article_id
 
+#
+# Steps for --concurrent-io. I/O threads load the article, check and
+# pre-filter it, resolve its domain and wait on BoilerPipe, worker
+# processes parse and analyse it, then an I/O thread persists it. Items
+# travel as (article_id, payload, content, extraction) until persisted.
+#
+
+def io_prepare(article_id):
+    article = load_raw_article(article_id)
+    if article is None:
+        return (article_id, None, None, None)
+    item = get_item(article)
+    if not worker.cp._check_processed(item):
+        return (article_id, False, None, None)
+
+    state = worker.cp.prepare_stage(item)
+    if state.finished or worker.cp.extractor.needs_tree:
+        return (article_id, state, article.content, None)
+
+    # parse_stage rejects these without extracting
+    page = worker.cp.page_content(article.content)
+    if over_node_budget(page, worker.cp.max_dom_nodes):
+        return (article_id, state, article.content, None)
+
+    # The version's learnt and the result cached here, since the worker
+    # processes' CrawlProcessors never see the extractor
+    job = worker.cp.submit_extraction(page)
+    job.join()
+    worker.cp._finish_extraction(job, page)
+    return (article_id, state, article.content, ExtractionResult(job.result, job.version, from_cache=True))
+
+def io_needs_compute(payload):
+    article_id, state, content, extraction = payload
+    return bool(state) and not state.finished
+
+def cpu_compute(payload):
+    article_id, state, content, extraction = payload
+    state = worker.cp.parse_stage(state, content, extraction)
+    return (article_id, worker.cp.analyse_stage(state), None, None)
+
+def io_finish(payload):
+    return stage_persist(payload[:2])
+
+def io_failed(step, arg):
+    # prepare gets an article id, later steps a payload
+    if step == "prepare":
+        return record_failure(arg)
+    return record_failure(arg[0])
+
+def get_concurrent_engine(io_threads, max_in_flight):
+    return ConcurrentIOEngine(io_prepare, cpu_compute, io_finish, io_needs_compute, io_failed,
+        io_threads=io_threads, io_initializer=io_worker_init,
+        cpu_initializer=cpu_worker_init, max_in_flight=max_in_flight)
+
+STAGE_WORKERS = {
+    "fetch":   1,
+    "extract": multiprocessing.cpu_count(),
+    "analyse": multiprocessing.cpu_count(),
+    "persist": 2,
+}
+
+def get_pipeline(stage_workers):
+    return StagedPipeline([
+        Stage("fetch",   stage_fetch,   stage_workers["fetch"],   worker_init, stage_failed),
+        Stage("extract", stage_extract, stage_workers["extract"], worker_init, stage_failed),
+        Stage("analyse", stage_analyse, stage_workers["analyse"], worker_init, stage_failed),
+        Stage("persist", stage_persist, stage_workers["persist"], worker_init, stage_persist_failed),
+    ])
+
+def locked(iterable, lock):
+    # ProcessQueue isn't thread-safe, and the pipeline reads its input on
+    # a feeder thread while the main thread marks items completed
+    it = iter(iterable)
+    while True:
+        with lock:
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+def batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if len(batch) == 0:
+            break
+        yield batch
+
 def main():
+    global profiler
+    global models
+    global keep_content
     core.configure_logging()
 
     multi   = "--multi" in sys.argv
+    staged  = "--pipeline" in sys.argv
+    concurrent = "--concurrent-io" in sys.argv
+    preload = "--no-preload" not in sys.argv
+    # Keeps raw pages once processed, so reprocess.py --stale can use them
+    keep_content = "--keep-content" in sys.argv
+    batch_size = 1
+    io_threads = IO_THREADS
+    max_in_flight = MAX_IN_FLIGHT
+    profile_every = profile_fraction = slow_seconds = None
+    stage_workers = dict(STAGE_WORKERS)
+    for pos, arg in enumerate(sys.argv):
+        if arg == "--batch-size":
+            batch_size = int(sys.argv[pos+1])
+        elif arg == "--profile-every":
+            profile_every = int(sys.argv[pos+1])
+        elif arg == "--profile-fraction":
+            profile_fraction = float(sys.argv[pos+1])
+        elif arg == "--slow-threshold":
+            slow_seconds = float(sys.argv[pos+1])
+        elif arg == "--io-threads":
+            io_threads = int(sys.argv[pos+1])
+        elif arg == "--max-in-flight":
+            max_in_flight = int(sys.argv[pos+1])
+        elif arg == "--stage-workers":
+            # e.g. --stage-workers extract=8,analyse=4
+            for spec in sys.argv[pos+1].split(","):
+                name, count = spec.split("=")
+                if name not in stage_workers:
+                    raise ValueError(("Unknown stage", name))
+                stage_workers[name] = int(count)
 
     engine = core.get_database_engine_string()
     logging.info("Using connection string '%s'" % (engine,))
@@ -86,8 +386,37 @@ def main():
     session = Session(bind=engine, autocommit = False)
     p  = ProcessQueue()
 
+    if preload:
+        start = timeit.default_timer()
+        models = preload_models()
+        gc.collect()
+        logging.info("Preloaded models in %.2fs, RSS %.1f MiB", timeit.default_timer() - start,
+            (current_rss() or 0) / 1048576.0)
+
+    if profile_every or profile_fraction or slow_seconds:
+        if staged or concurrent or batch_size > 1:
+            raise ValueError("Profiling only covers the default per-article workers")
+        logging.info("Profiling into %s", core.get_profile_dir())
+        profiler = SamplingProfiler(core.get_profile_dir(), profile_every, profile_fraction, slow_seconds)
+
     ids = None
-    if multi:
+    lock = threading.Lock()
+    if concurrent:
+        logging.info("Processing with %d I/O threads, up to %d articles in flight", io_threads, max_in_flight)
+        ids = get_concurrent_engine(io_threads, max_in_flight).run(locked(p, lock))
+    elif staged:
+        logging.info("Processing with a staged pipeline: %s", stage_workers)
+        ids = get_pipeline(stage_workers).run(locked(p, lock))
+    elif batch_size > 1:
+        logging.info("Processing in batches of %d articles", batch_size)
+        if multi:
+            pool = multiprocessing.Pool(None, worker_init)
+            ids  = pool.imap(worker_func_batch, batches(p, batch_size))
+        else:
+            worker_init()
+            ids = itertools.imap(worker_func_batch, batches(p, batch_size))
+        ids = itertools.chain.from_iterable(ids)
+    elif multi:
         pool = multiprocessing.Pool(None, worker_init)
         ids  = pool.imap(worker_func, p, 2)
     else:
@@ -96,7 +425,8 @@ def main():
 
     for article_id in ids:
         assert article_id is not None
-	p.set_completed(article_id)
+        with lock:
+            p.set_completed(article_id)
 
 if __name__ == "__main__":
     main()
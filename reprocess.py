@@ -10,18 +10,46 @@ from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.exc import *
 
 from backend import CrawlQueue, CrawlFileController, CrawlProcessor, ProcessQueue
+from backend import get_extractor
 from backend.db import RawArticle, CrawlController
+from backend.stage_cache import StageCache
+from backend.stale_stages import StaleStageReprocessor, BATCH_SIZE
 import core
 
+def reprocess_stale(engine, action, batch_size):
+    # Re-runs one stage for documents whose record for it is out of date
+    stage_cache = None
+    if core.get_stage_cache_path() is not None:
+        stage_cache = StageCache(core.get_stage_cache_path(), core.get_stage_cache_bytes())
+    cp = CrawlProcessor(engine, core.get_redis_host(), extractor=get_extractor(core.get_extractor_name()),
+        parse_mode=core.get_parse_mode(), max_page_bytes=core.get_max_page_bytes(),
+        max_dom_nodes=core.get_max_dom_nodes(), stage_cache=stage_cache)
+    r = StaleStageReprocessor(cp, batch_size)
+    r.run(action)
+    r.log_counters()
+
 def main():
 
     core.configure_logging()
 
-    p = ProcessQueue()
+    stale = None
+    batch_size = BATCH_SIZE
+    for pos, arg in enumerate(sys.argv):
+        if arg == "--stale":
+            # Dated or Classified
+            stale = sys.argv[pos+1]
+        elif arg == "--batch-size":
+            batch_size = int(sys.argv[pos+1])
 
     engine = core.get_database_engine_string()
     logging.info("Using connection string '%s'" % (engine,))
     engine = create_engine(engine, encoding='utf-8', isolation_level="READ COMMITTED")
+
+    if stale is not None:
+        return reprocess_stale(engine, stale, batch_size)
+
+    p = ProcessQueue()
+
     logging.info("Binding session...")
     session = Session(bind=engine, autocommit = False)
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+#
+# BoilerPipeClient against a local stub of the boilerpipe service
+#
+
+import os
+import sys
+import threading
+import time
+import unittest
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import requests
+
+from extractors import BoilerPipeClient
+
+VERSION = "BoilerPipeStub-1.0"
+
+RESPONSE = """<BoilerpipeResponse>
+<ServerInfo><Version>%s</Version></ServerInfo>
+<Response>%s</Response>
+</BoilerpipeResponse>"""
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    # content "fail:<n>:<text>" gets n 503s before succeeding, "sleep:<s>:<text>"
+    # waits s seconds first, anything else is extracted straight away
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length"))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        content = form["content"][0]
+        self.server.requests.append(content)
+
+        kind, arg, text = (content.split(":", 2) + [None, None])[:3]
+        if kind == "fail":
+            with self.server.lock:
+                seen = self.server.failures.get(content, 0)
+                self.server.failures[content] = seen + 1
+            if seen < int(arg):
+                self.send_response(503)
+                self.end_headers()
+                return
+        elif kind == "sleep":
+            time.sleep(float(arg))
+        else:
+            text = content
+
+        body = RESPONSE % (VERSION, "extracted " + text)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Timed-out clients hang up before the slow responses are sent
+        pass
+
+class BoilerPipeClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer(("127.0.0.1", 0), StubHandler)
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/extract" % (self.server.server_address[1],)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        kwargs.setdefault("pool_size", 4)
+        kwargs.setdefault("backoff", 0.01)
+        return BoilerPipeClient(self.url, **kwargs)
+
+    def test_extract(self):
+        req = self.client().submit("page")
+        req.join(5)
+        self.assertEqual(req.error, None)
+        self.assertEqual(req.version, VERSION)
+        self.assertEqual(req.result, "extracted page")
+
+    def test_5xx_then_retry(self):
+        req = self.client(retries=3).submit("fail:2:page")
+        req.join(5)
+        self.assertEqual(req.error, None)
+        self.assertEqual(req.result, "extracted page")
+        self.assertEqual(self.server.requests.count("fail:2:page"), 3)
+
+    def test_5xx_past_retries(self):
+        req = self.client(retries=1).submit("fail:5:page")
+        req.join(5)
+        self.assertEqual(req.result, None)
+        self.assertTrue(req.error is not None)
+        self.assertEqual(self.server.requests.count("fail:5:page"), 2)
+
+    def test_read_timeout(self):
+        req = self.client(retries=1, timeout=(1.0, 0.2)).submit("sleep:1:page")
+        req.join(10)
+        self.assertEqual(req.result, None)
+        self.assertTrue(isinstance(req.error, requests.Timeout))
+        self.assertEqual(self.server.requests.count("sleep:1:page"), 2)
+
+    def test_submit_many_order(self):
+        # Later pages finish first, results still come back in order
+        contents = ["sleep:%.2f:page%d" % (0.05 * (8 - i), i) for i in range(8)]
+        reqs = self.client().submit_many(contents)
+        for req in reqs:
+            req.join(10)
+        self.assertEqual([req.result for req in reqs], ["extracted page%d" % (i,) for i in range(8)])
+
+if __name__ == "__main__":
+    unittest.main()
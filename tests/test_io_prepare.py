@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+#
+# crawl_process.io_prepare's use of the stage cache for extractions
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import crawl_process
+
+from backend.crawl_processor import CrawlProcessor
+from backend.extractors import ExtractionResult
+from backend.stage_cache import StageCache
+
+PAGE = "<html><body><p>Some text</p></body></html>"
+
+class StubExtractor(object):
+    # Like BoilerPipe, the version only comes back with a result
+
+    needs_tree = False
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, content, tree=None):
+        self.submitted.append(content)
+        return ExtractionResult("extracted", "Stub-1.0")
+
+class StubState(object):
+    finished = False
+
+class StubArticle(object):
+    crawl_id = 1
+    headers = "h"
+    content = PAGE
+    url = "http://example.com/"
+    date_crawled = "2008-01-01"
+    content_type = "text/html"
+
+class IOPrepareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Only the parts of a CrawlProcessor io_prepare uses
+        cp = CrawlProcessor.__new__(CrawlProcessor)
+        cp.cache = StageCache(os.path.join(self.dir, "cache.db"))
+        cp.extractor = StubExtractor()
+        cp._extractor_version = None
+        cp.max_page_bytes = 1024
+        cp.max_dom_nodes = 1000
+        cp._check_processed = lambda item: True
+        cp.prepare_stage = lambda item: StubState()
+        crawl_process.worker.cp = cp
+        self.cp = cp
+
+        self.load_raw_article = crawl_process.load_raw_article
+        crawl_process.load_raw_article = lambda article_id: StubArticle()
+
+    def tearDown(self):
+        crawl_process.load_raw_article = self.load_raw_article
+        del crawl_process.worker.cp
+        shutil.rmtree(self.dir)
+
+    def test_second_prepare_is_cached(self):
+        crawl_process.io_prepare(1)
+        self.assertEqual(self.cp._extractor_version, "Stub-1.0")
+
+        article_id, state, content, job = crawl_process.io_prepare(2)
+        self.assertTrue(job.from_cache)
+        self.assertEqual(job.result, "extracted")
+        self.assertEqual(job.version, "Stub-1.0")
+        self.assertEqual(len(self.cp.extractor.submitted), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+#
+# KeywordResolutionWorker against SQLite and a dict standing in for redis
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from sqlalchemy import create_engine
+
+from keyword_ids import KeywordResolutionWorker
+
+class DictRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def mget(self, keys):
+        self.calls.append("mget")
+        return [self.data.get(key) for key in keys]
+
+    def mset(self, mapping):
+        self.calls.append("mset")
+        for key, value in mapping.items():
+            self.data[key] = str(value)
+
+class KeywordResolutionWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        # A file, since the worker's thread gets its own connection
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine("sqlite:///" + os.path.join(self.dir, "keywords.db"))
+        # NOCASE, like the MySQL column's default collation
+        self.engine.execute("CREATE TABLE keywords (id INTEGER PRIMARY KEY, `word` VARCHAR(32) NOT NULL UNIQUE COLLATE NOCASE)")
+        self.redis = DictRedis()
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def resolve(self, keywords):
+        worker = KeywordResolutionWorker(keywords, self.redis, self.engine)
+        worker.start()
+        worker.join()
+        return worker
+
+    def rows(self):
+        return dict(self.engine.execute("SELECT `word`, id FROM keywords").fetchall())
+
+    def test_misses_are_inserted(self):
+        worker = self.resolve(["apple", "banana", "cherry"])
+        rows = self.rows()
+        self.assertEqual(sorted(rows), ["apple", "banana", "cherry"])
+        self.assertEqual(worker.out_keywords, rows)
+        self.assertEqual(worker.round_trips, 5)
+        self.assertEqual(self.redis.calls, ["mget", "mset"])
+        self.assertEqual(self.redis.data, dict((word, str(_id)) for word, _id in rows.items()))
+
+    def test_hits_come_from_redis(self):
+        first = self.resolve(["apple", "banana"])
+        self.redis.calls = []
+        second = self.resolve(["banana", "apple"])
+        self.assertEqual(second.out_keywords, first.out_keywords)
+        self.assertEqual(second.round_trips, 1)
+        self.assertEqual(self.redis.calls, ["mget"])
+        self.assertEqual(len(self.rows()), 2)
+
+    def test_mixed(self):
+        first = self.resolve(["apple"])
+        worker = self.resolve(["apple", "durian"])
+        self.assertEqual(worker.out_keywords["apple"], first.out_keywords["apple"])
+        self.assertEqual(worker.out_keywords["durian"], self.rows()["durian"])
+        self.assertEqual(worker.round_trips, 5)
+
+    def test_existing_row_in_another_case(self):
+        self.engine.execute("INSERT INTO keywords (`word`) VALUES ('Apple')")
+        existing = self.rows()["Apple"]
+        worker = self.resolve(["apple", "APPLE"])
+        self.assertEqual(worker.out_keywords, {"apple": existing, "APPLE": existing})
+        self.assertEqual(len(self.rows()), 1)
+
+    def test_nothing_to_resolve(self):
+        worker = self.resolve([])
+        self.assertEqual(worker.out_keywords, {})
+        self.assertEqual(worker.round_trips, 0)
+        self.assertEqual(self.redis.calls, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+#
+# XZStreamWriter against a local object-store stand-in, on both the lzma
+# and xz -dc paths
+#
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import xz_stream
+from xz_stream import decompress_chunks
+
+def has_xz():
+    try:
+        subprocess.check_call(["xz", "--version"], stdout=open(os.devnull, "w"))
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+HAS_XZ = has_xz()
+
+def xz(data):
+    if xz_stream.lzma is not None:
+        return xz_stream.lzma.compress(data)
+    proc = subprocess.Popen(["xz", "-zc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return proc.communicate(data)[0]
+
+class LocalKey(object):
+    # Stands in for a boto Key: iterating it yields the object's bytes in
+    # BufferSize chunks, as a download does
+
+    BufferSize = 8192
+
+    def __init__(self, store, name):
+        self.path = os.path.join(store, name)
+
+    def __iter__(self):
+        with open(self.path, "rb") as fp:
+            while True:
+                chunk = fp.read(self.BufferSize)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+class XZStreamTestMixin(object):
+
+    use_lzma = True
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+        self.out = os.path.join(self.store, "out")
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def put(self, name, data):
+        with open(os.path.join(self.store, name), "wb") as fp:
+            fp.write(data)
+        return LocalKey(self.store, name)
+
+    def decompress(self, chunks):
+        ret = decompress_chunks(chunks, self.out, self.use_lzma)
+        with open(self.out, "rb") as fp:
+            return ret, fp.read()
+
+    def test_sqlite_file(self):
+        src = os.path.join(self.store, "src.db")
+        db = sqlite3.connect(src)
+        db.execute("CREATE TABLE articles (headers, content, site, date_crawled, content_type)")
+        for i in range(2000):
+            db.execute("INSERT INTO articles VALUES (?, ?, ?, ?, ?)",
+                ("h", "x" * (i % 500), "http://example.com/%d" % i, "2008-01-01", "text/html"))
+        db.commit()
+        db.close()
+        with open(src, "rb") as fp:
+            key = self.put("src.db.xz", xz(fp.read()))
+
+        (compressed, size), data = self.decompress(key)
+        self.assertEqual(compressed, os.path.getsize(key.path))
+        self.assertEqual(size, os.path.getsize(src))
+        db = sqlite3.connect(self.out)
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM articles").fetchone()[0], 2000)
+        db.close()
+
+    def test_stream_ends_on_chunk_boundary(self):
+        (compressed, size), data = self.decompress([xz(b"first "), xz(b"second")])
+        self.assertEqual(data, b"first second")
+
+    def test_stream_padding(self):
+        (compressed, size), data = self.decompress([xz(b"first ") + b"\0" * 4, b"\0" * 4, xz(b"second"), b"\0" * 8])
+        self.assertEqual(data, b"first second")
+
+    def test_small_chunks(self):
+        data = xz(b"a" * 10000) + xz(b"b" * 10000)
+        (compressed, size), out = self.decompress([data[i:i+7] for i in range(0, len(data), 7)])
+        self.assertEqual(out, b"a" * 10000 + b"b" * 10000)
+
+    def test_truncated(self):
+        data = xz(os.urandom(50000))
+        self.assertRaises((EOFError, subprocess.CalledProcessError), decompress_chunks, [data[:len(data) // 2]], self.out, self.use_lzma)
+        self.assertFalse(os.path.exists(self.out))
+
+    def test_truncated_second_stream(self):
+        second = xz(os.urandom(50000))
+        self.assertRaises((EOFError, subprocess.CalledProcessError), decompress_chunks, [xz(b"first"), second[:100]], self.out, self.use_lzma)
+        self.assertFalse(os.path.exists(self.out))
+
+@unittest.skipIf(xz_stream.lzma is None, "no lzma module")
+class LZMAStreamTest(XZStreamTestMixin, unittest.TestCase):
+    use_lzma = True
+
+@unittest.skipIf(not HAS_XZ, "no xz binary")
+class XZProcessStreamTest(XZStreamTestMixin, unittest.TestCase):
+    use_lzma = False
+
+if __name__ == "__main__":
+    unittest.main()